@@ -5,28 +5,342 @@
 
 import sqlite3
 import os
+import sys
 import json
+import math
+import gzip
+import hashlib
+import hmac
+import mimetypes
+import multiprocessing
+import cProfile
+import csv
+import io
+import pstats
+import queue
+import re
+import threading
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
 from datetime import datetime, date, timedelta
-from flask import Flask, render_template, send_from_directory, jsonify, session, redirect, url_for
+from decimal import Decimal, ROUND_HALF_UP
+from flask import Flask, render_template, send_from_directory, jsonify, session, redirect, url_for, g, has_app_context, Response
+from flask import abort, make_response
 from flask import request as flask_request
-from werkzeug.security import check_password_hash, generate_password_hash
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.security import check_password_hash, generate_password_hash, DEFAULT_PBKDF2_ITERATIONS
 from werkzeug.utils import secure_filename
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 basedir = os.path.dirname(os.path.abspath(__file__))
 frontend_dir = os.path.join(basedir, '../Frontend')
-db_path = os.path.join(basedir, '../database/school_canteen.db')
+db_path = os.environ.get('DB_PATH', os.path.join(basedir, '../database/school_canteen.db'))
+
+sys.path.append(os.path.join(basedir, '../database'))
+from init_db import migrate, MIGRATIONS, MATERIALIZE_LEDGER, REFRESH_POPULARITY, ARCHIVED_TABLES, archive_path, tenant_path, TENANT_RE
+from init_db import (BALANCE_SQL, LOGIN_USER, MENU_FOR_DAY, ORDERS_BY_USER, PENDING_REQUESTS, DISHES_RESERVED, ORDERS_TO_COLLECT,
+                     STATS_TODAY_BY_MEAL, STATS_TODAY_BY_DISH, STATS_TODAY_ORDERS, STATS_TODAY_REVENUE, STATS_REVENUE_WEEK,
+                     EXPORT_PAYMENTS_SPAN, EXPORT_PAYMENTS, EXPORT_ORDERS_SPAN, EXPORT_ORDERS, EXPORT_USER_TOTALS)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    # orjson when installed, the stdlib encoder otherwise; both emit UTF-8 rather than \u escapes (half the bytes
+    # for Cyrillic), skip key sorting and take sqlite3.Row directly, so routes need not copy rows into dicts
+    ensure_ascii = False
+    sort_keys = False
+    orjson_options = orjson and orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, sqlite3.Row): return dict(o)
+        if isinstance(o, Decimal): return float(o)
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs: return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self.orjson_options).decode()
+
+    def response(self, *args, **kwargs):
+        if orjson is None or self._app.debug: return super().response(*args, **kwargs)
+        body = orjson.dumps(self._prepare_response_obj(args, kwargs), default=self.default, option=self.orjson_options)
+        return self._app.response_class(body, mimetype=self.mimetype)
 
 
 app = Flask(__name__, template_folder=frontend_dir, static_folder=frontend_dir)
+app.json = FastJSONProvider(app)
 app.secret_key = 'secretKey123'
+app.config.update(
+    DB_POOL_SIZE=int(os.environ.get('DB_POOL_SIZE', 8)),
+    DB_JOURNAL_MODE=os.environ.get('DB_JOURNAL_MODE', 'WAL'),
+    DB_SYNCHRONOUS=os.environ.get('DB_SYNCHRONOUS', 'NORMAL'),
+    DB_CACHE_SIZE=int(os.environ.get('DB_CACHE_SIZE', -16000)),
+    DB_MMAP_SIZE=int(os.environ.get('DB_MMAP_SIZE', 64 * 1024 * 1024)),
+    DB_BUSY_TIMEOUT=int(os.environ.get('DB_BUSY_TIMEOUT', 5000)),
+    DB_CACHED_STATEMENTS=int(os.environ.get('DB_CACHED_STATEMENTS', 256)),
+    DB_WRITE_RETRIES=int(os.environ.get('DB_WRITE_RETRIES', 5)),
+    WRITE_QUEUE=os.environ.get('WRITE_QUEUE') == '1',
+    WRITE_BATCH_MS=float(os.environ.get('WRITE_BATCH_MS', 2)),
+    WRITE_BATCH_SIZE=int(os.environ.get('WRITE_BATCH_SIZE', 64)),
+    WRITE_TIMEOUT=float(os.environ.get('WRITE_TIMEOUT', 10)),
+    PRINCIPAL_CACHE_SIZE=int(os.environ.get('PRINCIPAL_CACHE_SIZE', 5000)),
+    PRINCIPAL_CACHE_TTL=int(os.environ.get('PRINCIPAL_CACHE_TTL', 30)),
+    MENU_CACHE_TTL=float(os.environ.get('MENU_CACHE_TTL', 5)),
+    STATIC_MAX_AGE=int(os.environ.get('STATIC_MAX_AGE', 365 * 24 * 3600)),
+    COMPRESS_MIN_SIZE=int(os.environ.get('COMPRESS_MIN_SIZE', 1024)),
+    COMPRESS_LEVEL=int(os.environ.get('COMPRESS_LEVEL', 6)),
+    COMPRESS_CACHE_SIZE=int(os.environ.get('COMPRESS_CACHE_SIZE', 256)),
+    SLOW_QUERY_MS=float(os.environ.get('SLOW_QUERY_MS', 100)),
+    PROFILE_HEADER='X-Profile',
+    EXPORT_CHUNK_SIZE=int(os.environ.get('EXPORT_CHUNK_SIZE', 1000)),
+    EVENTS_HEARTBEAT=int(os.environ.get('EVENTS_HEARTBEAT', 15)),
+    EVENTS_QUEUE_SIZE=int(os.environ.get('EVENTS_QUEUE_SIZE', 100)),
+    EVENTS_REPLAY_SIZE=int(os.environ.get('EVENTS_REPLAY_SIZE', 500)),
+    # each open stream holds a gthread thread, so only a quarter of them may; the rest of the clients poll
+    EVENTS_MAX_STREAMS=int(os.environ.get('EVENTS_MAX_STREAMS', max(1, int(os.environ.get('WEB_THREADS', 32)) // 4))),
+    EVENTS_POLL_RETRY=int(os.environ.get('EVENTS_POLL_RETRY', 5000)),
+    FORECAST_HISTORY_DAYS=int(os.environ.get('FORECAST_HISTORY_DAYS', 28)),
+    FORECAST_DAYS=int(os.environ.get('FORECAST_DAYS', 14)),
+    PASSWORD_HASH_METHOD=os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1'),
+    HASH_WORKERS=int(os.environ.get('HASH_WORKERS', os.cpu_count() or 1)),
+    HASH_QUEUE_SIZE=int(os.environ.get('HASH_QUEUE_SIZE', 64)),
+    HASH_TIMEOUT=float(os.environ.get('HASH_TIMEOUT', 10)),
+    LOGIN_RATE=float(os.environ.get('LOGIN_RATE', 0.2)),
+    LOGIN_BURST=int(os.environ.get('LOGIN_BURST', 5)),
+    LOGIN_BUCKETS=int(os.environ.get('LOGIN_BUCKETS', 10000)),
+    LEDGER_BATCH=int(os.environ.get('LEDGER_BATCH', 200)),
+    RATING_PRIOR=float(os.environ.get('RATING_PRIOR', 5)),
+    POPULARITY_REFRESH=int(os.environ.get('POPULARITY_REFRESH', 60)),
+    TENANTS_DIR=os.environ.get('TENANTS_DIR'),
+    TENANT_DOMAIN=os.environ.get('TENANT_DOMAIN'),
+    TENANT_POOL_SIZE=int(os.environ.get('TENANT_POOL_SIZE', 32)),
+)
+
+shutting_down = threading.Event()
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+_metrics_lock = threading.Lock()
+_route_latency = {}
+_route_sql = {}
+_slow_queries = [0]
+_lock_waits = [0]
+
+
+def observe_request(endpoint, method, status, seconds, sql_count, sql_seconds):
+    with _metrics_lock:
+        h = _route_latency.setdefault((endpoint, method), [[0] * len(LATENCY_BUCKETS), 0, 0.0, {}])
+        for i, le in enumerate(LATENCY_BUCKETS):
+            if seconds <= le: h[0][i] += 1
+        h[1] += 1
+        h[2] += seconds
+        h[3][status] = h[3].get(status, 0) + 1
+        q = _route_sql.setdefault(endpoint, [0, 0.0])
+        q[0] += sql_count
+        q[1] += sql_seconds
+
+
+def describe_params(params):
+    # only the shape of the parameters goes to the log: values include password hashes and personal data
+    if isinstance(params, str): return params
+    if isinstance(params, dict): return '{' + ', '.join(f'{k}: {type(v).__name__}' for k, v in params.items()) + '}'
+    return '(' + ', '.join(type(v).__name__ for v in params) + ')'
+
+
+def record_sql(sql, params, seconds):
+    if has_app_context():
+        g.sql_count = g.get('sql_count', 0) + 1
+        g.sql_seconds = g.get('sql_seconds', 0.0) + seconds
+    if seconds * 1000 >= app.config['SLOW_QUERY_MS']:
+        sql = ' '.join(sql.split())
+        if sql.upper().startswith('BEGIN'):
+            # waiting for another writer's lock, not a slow statement
+            with _metrics_lock: _lock_waits[0] += 1
+            app.logger.info('write lock wait %.1fms', seconds * 1000)
+            return
+        with _metrics_lock: _slow_queries[0] += 1
+        app.logger.warning('slow query %.1fms: %s %s', seconds * 1000, sql, describe_params(params))
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    def execute(self, sql, params=()):
+        t = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            record_sql(sql, params, time.perf_counter() - t)
 
+    def executemany(self, sql, seq):
+        seq = list(seq)
+        t = time.perf_counter()
+        try:
+            return super().executemany(sql, seq)
+        finally:
+            record_sql(sql, f'<{len(seq)} rows>', time.perf_counter() - t)
 
-def get_db_connection():
-    conn = sqlite3.connect(db_path)
+
+class PooledConnection(InstrumentedConnection):
+    # routes still call close(); the connection goes back to the pool in release_db_connection()
+    def close(self): pass
+
+
+def open_db_connection(factory=InstrumentedConnection, tenant=None):
+    cfg = app.config
+    tenant = tenant or current_tenant()
+    conn = sqlite3.connect(tenant.db_path, timeout=cfg['DB_BUSY_TIMEOUT'] / 1000, factory=factory,
+                           cached_statements=cfg['DB_CACHED_STATEMENTS'], check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    conn.tenant = tenant
+    conn.execute(f"PRAGMA journal_mode={cfg['DB_JOURNAL_MODE']}")
+    conn.execute(f"PRAGMA synchronous={cfg['DB_SYNCHRONOUS']}")
+    conn.execute(f"PRAGMA cache_size={cfg['DB_CACHE_SIZE']}")
+    conn.execute(f"PRAGMA mmap_size={cfg['DB_MMAP_SIZE']}")
+    conn.execute(f"PRAGMA busy_timeout={cfg['DB_BUSY_TIMEOUT']}")
+    attach_archive(conn)
     return conn
 
 
+def attach_archive(conn):
+    # the archive (see init_db.archive) may appear after a pooled connection was opened, so this is re-checked
+    if any(r[1] == 'archive' for r in conn.execute('PRAGMA database_list')): return True
+    path = archive_path(conn.tenant.db_path)
+    if not os.path.exists(path): return False
+    conn.execute('ATTACH DATABASE ? AS archive', (path,))
+    return True
+
+
+def history(conn, table):
+    # live rows only, unless the request asks for ?archive=1 and an archive exists
+    if flask_request.args.get('archive') != '1' or not attach_archive(conn): return table
+    cols = ARCHIVED_TABLES[table][1]
+    return f'(SELECT {cols} FROM main.{table} UNION ALL SELECT {cols} FROM archive.{table})'
+
+
+def get_db_connection():
+    if not has_app_context(): return open_db_connection()
+    if 'db' not in g:
+        tenant = current_tenant()
+        with tenant.pool_lock:
+            conn = tenant.pool.pop() if tenant.pool else None
+        g.db = conn or open_db_connection(PooledConnection, tenant)
+    return g.db
+
+
+def run_immediate(conn, fn, *args):
+    # fn runs inside BEGIN IMMEDIATE, so its reads and conditional writes see no concurrent writer
+    retries = app.config['DB_WRITE_RETRIES']
+    for attempt in range(retries):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError as e:
+            if attempt == retries - 1 or ('locked' not in str(e) and 'busy' not in str(e)): raise
+            time.sleep(0.01 * 2 ** attempt)
+            continue
+        try:
+            res = fn(conn, *args)
+            conn.commit()
+            return res
+        except:
+            conn.rollback()
+            raise
+
+
+@app.teardown_appcontext
+def release_db_connection(exc):
+    conn = g.pop('db', None)
+    if conn is None: return
+    try:
+        if conn.in_transaction: conn.rollback()
+    except sqlite3.Error:
+        sqlite3.Connection.close(conn); return
+    tenant = conn.tenant
+    with tenant.pool_lock:
+        if not tenant.closed and len(tenant.pool) < app.config['DB_POOL_SIZE']:
+            tenant.pool.append(conn); return
+    sqlite3.Connection.close(conn)
+
+
+_event_subscribers = set()
+_event_history = deque(maxlen=app.config['EVENTS_REPLAY_SIZE'])
+_event_lock = threading.Lock()
+_event_seq = 0
+_event_streams = 0
+
+
+def _event_matches(ev, tenant, role, user_id):
+    return ev['tenant'] == tenant and (ev['role'] is None or ev['role'] == role) and (ev['user_id'] is None or ev['user_id'] == user_id)
+
+
+def publish_event(name, data, role=None, user_id=None):
+    global _event_seq
+    with _event_lock:
+        _event_seq += 1
+        ev = {'id': _event_seq, 'name': name, 'data': data, 'tenant': current_tenant().name, 'role': role,
+              'user_id': user_id}
+        _event_history.append(ev)
+        subs = list(_event_subscribers)
+    for sub in subs:
+        if not _event_matches(ev, *sub[:3]): continue
+        try:
+            sub[3].put_nowait(ev)
+        except queue.Full:
+            pass
+
+
+def subscribe_events(role, user_id, last_id=0):
+    sub = (current_tenant().name, role, user_id, queue.Queue(maxsize=app.config['EVENTS_QUEUE_SIZE']))
+    with _event_lock:
+        _event_subscribers.add(sub)
+        missed = [ev for ev in _event_history if ev['id'] > last_id and _event_matches(ev, *sub[:3])] if last_id else []
+    for ev in missed[-app.config['EVENTS_QUEUE_SIZE']:]: sub[3].put_nowait(ev)
+    return sub
+
+
+def poll_events(role, user_id, last_id=None):
+    # what a polling client missed since last_id (nothing on its first poll), and the newest id so its next
+    # Last-Event-ID starts there
+    tenant = current_tenant().name
+    with _event_lock:
+        missed = [] if last_id is None else [
+            ev for ev in _event_history if ev['id'] > last_id and _event_matches(ev, tenant, role, user_id)]
+        return missed, _event_seq
+
+
+def unsubscribe_events(sub):
+    with _event_lock: _event_subscribers.discard(sub)
+
+
+def take_event_stream():
+    global _event_streams
+    with _event_lock:
+        if _event_streams >= app.config['EVENTS_MAX_STREAMS']: return False
+        _event_streams += 1
+        return True
+
+
+def release_event_stream():
+    global _event_streams
+    with _event_lock: _event_streams -= 1
+
+
+def format_sse(ev):
+    head = f"id: {ev['id']}\n" if ev.get('id') else ''
+    return f"{head}event: {ev['name']}\ndata: {json.dumps(ev['data'], ensure_ascii=False)}\n\n"
+
+
+def publish_pending_count(conn):
+    c = conn.execute(PENDING_REQUESTS).fetchone()['c']
+    publish_event('pending', {'pending_count': c}, role='admin')
+
+
 def format_user_id(uid):
     return str(uid).zfill(8)
 
@@ -39,16 +353,687 @@ def redirect_to_role_page():
     return redirect('/login')
 
 
-def check_subscription(user_id):
+def subscription_active(end_date):
+    if not end_date: return False
+    try:
+        return datetime.strptime(end_date, '%Y-%m-%d').date() >= date.today()
+    except:
+        return False
+
+
+class PrincipalCache:
+    # bounded LRU of user rows with a TTL, so other workers' writes become visible after at most ttl seconds
+    def __init__(self, size, ttl):
+        self.size, self.ttl = size, ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, uid, loader):
+        now = time.monotonic()
+        with self.lock:
+            item = self.items.get(uid)
+            if item and item[0] > now:
+                self.items.move_to_end(uid)
+                self.hits += 1
+                return item[1]
+            self.misses += 1
+        value = loader(uid)
+        with self.lock:
+            if value is not None:
+                self.items[uid] = (now + self.ttl, value)
+                self.items.move_to_end(uid)
+                while len(self.items) > self.size:
+                    self.items.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, uid=None):
+        with self.lock:
+            if uid is None: self.items.clear()
+            else: self.items.pop(uid, None)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'size': len(self.items), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': round(self.hits / total, 4) if total else 0.0}
+
+
+def load_principal(uid):
     conn = get_db_connection()
-    user = conn.execute('SELECT subscription_end_date FROM users WHERE id=?', (user_id,)).fetchone()
+    u = conn.execute(f'SELECT id, username, email, role, ({BALANCE_SQL}) / 100.0 AS balance, subscription_end_date FROM users u WHERE id=?',
+                     (uid,)).fetchone()
+    if not u: conn.close(); return None
+    u = dict(u)
+    u['allergens'] = frozenset(r[0] for r in conn.execute('SELECT ingredient_id FROM allergens WHERE user_id=?', (uid,)))
     conn.close()
-    if user and user['subscription_end_date']:
+    return u
+
+
+def get_principal(uid):
+    principals = g.setdefault('principals', {})
+    if uid not in principals: principals[uid] = current_tenant().principals.get(uid, load_principal)
+    return principals[uid]
+
+
+def invalidate_principal(uid=None):
+    current_tenant().principals.invalidate(uid)
+    if uid is None: g.pop('principals', None)
+    else: g.get('principals', {}).pop(uid, None)
+
+
+def check_subscription(user_id):
+    user = get_principal(user_id)
+    return subscription_active(user['subscription_end_date']) if user else False
+
+
+LEDGER_POST = f'''INSERT INTO ledger (user_id, seq, amount_cents, kind, payment_id)
+SELECT u.id, COALESCE((SELECT MAX(seq) FROM ledger WHERE user_id = u.id), 0) + 1, :cents, :kind, :payment
+FROM users u WHERE u.id = :uid AND (:cents >= 0 OR {BALANCE_SQL} + :cents >= 0)'''
+
+_ledger_lock = threading.Lock()
+
+
+def to_cents(amount):
+    return int((Decimal(str(amount)) * 100).quantize(Decimal(1), ROUND_HALF_UP))
+
+
+def post_ledger(conn, user_id, cents, kind, payment_id=None):
+    # append-only; a debit that would overdraw inserts nothing and returns False. Every LEDGER_BATCH appends
+    # the writer that crosses the mark folds the backlog into users.balance_cents inside its own transaction.
+    if not conn.execute(LEDGER_POST, {'uid': user_id, 'cents': cents, 'kind': kind, 'payment': payment_id}).rowcount:
+        return False
+    tenant = current_tenant()
+    with _ledger_lock:
+        tenant.ledger_unmaterialized += 1
+        due = tenant.ledger_unmaterialized >= app.config['LEDGER_BATCH']
+        if due: tenant.ledger_unmaterialized = 0
+    if due:
+        for sql in MATERIALIZE_LEDGER: conn.execute(sql)
+    return True
+
+
+class HashBusy(Exception):
+    pass
+
+
+_hash_pool = None
+_hash_pool_lock = threading.Lock()
+_hash_slots = threading.BoundedSemaphore(app.config['HASH_QUEUE_SIZE'])
+
+
+def hash_pool():
+    # created on first use, i.e. after gunicorn has forked; spawn keeps the children free of our threads and sockets
+    global _hash_pool
+    with _hash_pool_lock:
+        if _hash_pool is None and app.config['HASH_WORKERS'] > 0:
+            _hash_pool = ProcessPoolExecutor(app.config['HASH_WORKERS'], mp_context=multiprocessing.get_context('spawn'))
+        return _hash_pool
+
+
+def run_hash(fn, *args):
+    # the request thread only waits on the future, so other requests keep the GIL while a hash is computed
+    pool = hash_pool()
+    if pool is None: return fn(*args)
+    # a full queue is answered at once; HASH_TIMEOUT only bounds the hash itself
+    if not _hash_slots.acquire(blocking=False): raise HashBusy()
+    try:
+        future = pool.submit(fn, *args)
         try:
-            return datetime.strptime(user['subscription_end_date'], '%Y-%m-%d').date() >= date.today()
-        except:
-            return False
-    return False
+            return future.result(timeout=app.config['HASH_TIMEOUT'])
+        except TimeoutError:
+            future.cancel()
+            raise HashBusy()
+    finally:
+        _hash_slots.release()
+
+
+def hash_password(password):
+    return run_hash(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+
+def verify_password(pw_hash, password):
+    return run_hash(check_password_hash, pw_hash, password)
+
+
+def hash_prefix(method):
+    # the method as werkzeug writes it into the hash, with its defaults filled in ('pbkdf2' -> 'pbkdf2:sha256:1000000')
+    name, *args = method.split(':')
+    if name == 'scrypt' and not args: args = ['32768', '8', '1']
+    elif name == 'pbkdf2' and len(args) < 2: args = (args or ['sha256']) + [str(DEFAULT_PBKDF2_ITERATIONS)]
+    return ':'.join([name] + args)
+
+
+def needs_rehash(pw_hash):
+    return pw_hash.split('$', 1)[0] != hash_prefix(app.config['PASSWORD_HASH_METHOD'])
+
+
+class TokenBuckets:
+    # per-key token bucket (rate tokens/s, up to burst), LRU-bounded so a spray of identifiers can't grow it forever
+    def __init__(self, rate, burst, size):
+        self.rate, self.burst, self.size = rate, burst, size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.throttled = 0
+
+    def take(self, key):
+        # returns 0 when a token was taken, otherwise the seconds until the next one
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.items.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / self.rate
+            self.items[key] = (tokens - 1 if not wait else tokens, now)
+            while len(self.items) > self.size: self.items.popitem(last=False)
+            if wait: self.throttled += 1
+            return wait
+
+
+login_buckets = TokenBuckets(app.config['LOGIN_RATE'], app.config['LOGIN_BURST'], app.config['LOGIN_BUCKETS'])
+
+
+STATS_UPSERT = '''INSERT INTO daily_stats (day, meal_type, dish_id, orders, sold, issued, revenue) VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(day, meal_type, dish_id) DO UPDATE SET orders=orders+excluded.orders, sold=sold+excluded.sold,
+    issued=issued+excluded.issued, revenue=revenue+excluded.revenue'''
+
+
+def bump_stats(conn, day, meal_type, dish_id, orders=0, sold=0, issued=0, revenue=0):
+    conn.execute(STATS_UPSERT, (day, meal_type, dish_id, orders, sold, issued, revenue))
+    if issued: bump_total(conn, 'issued', issued)
+
+
+def bump_total(conn, name, value):
+    conn.execute('INSERT INTO stats_totals (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value=value+excluded.value',
+                 (name, value))
+
+
+def bump_payments(conn, amount):
+    # payment_date defaults to CURRENT_TIMESTAMP (UTC), so the rollup day is date('now') as well
+    conn.execute(
+        "INSERT INTO daily_payments (day, revenue, transactions) VALUES (date('now'), ?, 1) ON CONFLICT(day) DO UPDATE SET revenue=revenue+excluded.revenue, transactions=transactions+1",
+        (amount,))
+
+
+def bump_issued(conn, order_ids):
+    if not order_ids: return
+    rows = conn.execute(
+        f"SELECT o.order_day, m.meal_type, m.dish_id, COUNT(*) as n FROM orders o JOIN menu m ON o.menu_id=m.id WHERE o.id IN ({','.join('?' * len(order_ids))}) GROUP BY o.order_day, m.meal_type, m.dish_id",
+        list(order_ids)).fetchall()
+    conn.executemany(STATS_UPSERT, [(r['order_day'], r['meal_type'], r['dish_id'], 0, 0, r['n'], 0) for r in rows])
+    bump_total(conn, 'issued', len(order_ids))
+    portions = {}
+    for r in rows: portions[r['dish_id']] = portions.get(r['dish_id'], 0) + r['n']
+    consume_ingredients(conn, portions)
+
+
+CONSUME_SQL = '''UPDATE ingredients SET current_quantity = MAX(current_quantity - u.used, 0)
+FROM (SELECT di.ingredient_id, SUM(di.quantity * p.value) AS used FROM json_each(?) p
+      JOIN dish_ingredients di ON di.dish_id = CAST(p.key AS INTEGER) GROUP BY di.ingredient_id) u
+WHERE ingredients.id = u.ingredient_id'''
+
+
+def consume_ingredients(conn, portions):
+    # portions: {dish_id: served portions}; the whole batch is deducted by recipe in one statement
+    if portions: conn.execute(CONSUME_SQL, (json.dumps(portions),))
+
+
+# Expected portions per upcoming menu row = the dish's historical take rate (issued per day on the menu,
+# falling back to the average rate), never less than what is already booked, minus what was already served.
+FORECAST_SQL = '''WITH
+on_menu AS (SELECT dish_id, COUNT(DISTINCT date) AS days FROM menu WHERE date >= :since AND date < :today GROUP BY dish_id),
+taken AS (SELECT dish_id, SUM(issued) AS n FROM daily_stats WHERE day >= :since AND day < :today GROUP BY dish_id),
+rate AS (SELECT m.dish_id, COALESCE(t.n, 0) * 1.0 / m.days AS r FROM on_menu m LEFT JOIN taken t USING (dish_id)),
+plan AS (
+    SELECT m.date, m.dish_id,
+           MAX(MAX(COALESCE(rate.r, (SELECT AVG(r) FROM rate), 0), COUNT(o.id)) - COALESCE(SUM(o.collected), 0), 0) AS portions
+    FROM menu m LEFT JOIN rate USING (dish_id) LEFT JOIN orders o ON o.menu_id = m.id
+    WHERE m.date >= :today AND m.date < :until GROUP BY m.id),
+need AS (SELECT p.date, di.ingredient_id, SUM(p.portions * di.quantity) AS used
+         FROM plan p JOIN dish_ingredients di ON di.dish_id = p.dish_id GROUP BY p.date, di.ingredient_id),
+running AS (SELECT ingredient_id, date, used, SUM(used) OVER (PARTITION BY ingredient_id ORDER BY date) AS cum FROM need)
+SELECT i.id, i.name, i.unit, i.current_quantity, i.min_quantity,
+       ROUND(COALESCE(SUM(r.used), 0), 3) AS forecast_use,
+       MIN(CASE WHEN i.current_quantity - r.cum < i.min_quantity THEN r.date END) AS below_min_on,
+       MIN(CASE WHEN i.current_quantity - r.cum < 0 THEN r.date END) AS depleted_on
+FROM ingredients i LEFT JOIN running r ON r.ingredient_id = i.id
+GROUP BY i.id ORDER BY below_min_on IS NULL, below_min_on, i.name'''
+
+
+def forecast_ingredients(conn, days):
+    today = date.today()
+    return conn.execute(FORECAST_SQL, {
+        'today': today.isoformat(), 'until': (today + timedelta(days=days)).isoformat(),
+        'since': (today - timedelta(days=app.config['FORECAST_HISTORY_DAYS'])).isoformat()}).fetchall()
+
+
+def draft_purchase_requests(conn, user_id, days):
+    # one draft per ingredient forecast to cross min_quantity, topping it up to min_quantity plus the
+    # forecast use, net of requests that are still open
+    open_qty = dict(conn.execute(
+        "SELECT ingredient_id, SUM(quantity) FROM purchase_requests WHERE status IN ('draft', 'pending') GROUP BY ingredient_id").fetchall())
+    drafts = []
+    for r in forecast_ingredients(conn, days):
+        if not r['below_min_on']: continue
+        qty = math.ceil(r['forecast_use'] + r['min_quantity'] - r['current_quantity'] - open_qty.get(r['id'], 0))
+        if qty > 0: drafts.append((r['id'], qty, user_id, f"Прогноз: ниже минимума {r['below_min_on']}"))
+    conn.executemany(
+        "INSERT INTO purchase_requests (ingredient_id, quantity, requested_by, status, notes) VALUES (?, ?, ?, 'draft', ?)",
+        drafts)
+    return drafts
+
+
+def page_args(default_limit=None, pair=False):
+    # keyset pagination: ?after=<cursor of the last row seen>&limit=<page size>; the cursor is an id, or with
+    # pair=True '<sort key>,<id>' parsed into a tuple; a malformed value is a 400, the limit is clamped to 1..500
+    args = flask_request.args
+    try:
+        limit = int(args['limit']) if 'limit' in args else default_limit
+        after = args.get('after') or None
+        if after and pair:
+            key, sep, rid = after.rpartition(',')
+            if not sep: raise ValueError(after)
+            after = (key, int(rid))
+        elif after:
+            after = int(after)
+    except ValueError:
+        abort(make_response(jsonify({'status': 'error', 'message': 'Неверные параметры страницы'}), 400))
+    return after, max(1, min(limit, 500)) if limit is not None else None
+
+
+def paged(rows, limit, cursor):
+    # ?shape=columns sends {"columns": [...], "rows": [[...], ...]}: no per-row objects and no repeated keys
+    if flask_request.args.get('shape') == 'columns':
+        resp = jsonify({'columns': list(rows[0].keys()) if rows else [], 'rows': [tuple(r) for r in rows]})
+    else:
+        resp = jsonify(rows)
+    if limit and len(rows) == limit: resp.headers['X-Next-After'] = cursor(rows[-1])
+    return resp
+
+
+def normalize_ident(ident):
+    return ident.strip().casefold()
+
+
+class StudentDirectory:
+    # username / email (case-folded) -> user id, warmed at startup and kept current by register and role changes;
+    # a miss (e.g. a user added by another worker) falls back to the NOCASE indexes and is remembered
+    def __init__(self):
+        self.by_ident, self.by_id = {}, {}
+        self.lock = threading.Lock()
+
+    def add(self, uid, username, email, role):
+        with self.lock:
+            self.by_id[uid] = {'id': uid, 'username': username, 'role': role}
+            for key in (username, email): self.by_ident.setdefault(normalize_ident(key), uid)
+
+    def set_role(self, uid, role):
+        with self.lock:
+            if uid in self.by_id: self.by_id[uid] = dict(self.by_id[uid], role=role)
+
+    def get(self, uid):
+        with self.lock: return self.by_id.get(uid)
+
+    def lookup(self, ident):
+        with self.lock: return self.by_ident.get(normalize_ident(ident))
+
+    def warm(self, conn):
+        for r in conn.execute('SELECT id, username, email, role FROM users ORDER BY id'): self.add(*r)
+
+    def __len__(self):
+        return len(self.by_id)
+
+
+TOKEN_RE = re.compile(r'S([0-9A-Z]+)-([0-9A-F]{8})')
+
+
+def token_signature(uid):
+    # a school's codes are signed with its name, so they are not valid at another school's serving line
+    tenant = current_tenant().name
+    msg = f'student:{uid}' if tenant == default_tenant.name else f'student:{tenant}:{uid}'
+    return hmac.new(app.secret_key.encode(), msg.encode(), hashlib.sha256).hexdigest()[:8].upper()
+
+
+def student_token(uid):
+    # compact QR/barcode payload (QR alphanumeric charset): S<id in base36>-<signature>
+    digits, n = '', uid
+    while True:
+        n, r = divmod(n, 36)
+        digits = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'[r] + digits
+        if not n: return f'S{digits}-{token_signature(uid)}'
+
+
+def parse_student_token(ident):
+    m = TOKEN_RE.fullmatch(ident.upper())
+    if not m: return None
+    uid = int(m.group(1), 36)
+    return uid if hmac.compare_digest(m.group(2), token_signature(uid)) else None
+
+
+def find_student(conn, ident):
+    students = current_tenant().students
+    uid = int(ident) if ident.isdigit() else parse_student_token(ident) or students.lookup(ident)
+    student = students.get(uid) if uid else None
+    if student: return student
+    r = conn.execute('SELECT id, username, email, role FROM users WHERE id=?', (uid,)).fetchone() if uid else conn.execute(
+        'SELECT id, username, email, role FROM users WHERE email=? COLLATE NOCASE OR username=? COLLATE NOCASE ORDER BY id',
+        (ident, ident)).fetchone()
+    if not r: return None
+    students.add(*r)
+    return students.get(r['id'])
+
+
+class OrderError(Exception):
+    pass
+
+
+def run_items(conn, fn, items):
+    # one savepoint per item: a failed item is rolled back alone and the batch still commits once
+    results = []
+    for key, args in items:
+        conn.execute('SAVEPOINT item')
+        try:
+            res = fn(conn, *args)
+            conn.execute('RELEASE item')
+            results.append({'id': key, 'status': 'success', 'result': res})
+        except OrderError as e:
+            conn.execute('ROLLBACK TO item'); conn.execute('RELEASE item')
+            results.append({'id': key, 'status': 'error', 'message': str(e)})
+    return results
+
+
+class WriteBusy(Exception):
+    pass
+
+
+class WriteQueue:
+    # group commit: request threads enqueue write functions and wait on a future, one writer thread applies
+    # everything queued so far in a single BEGIN IMMEDIATE, each function under its own savepoint
+    def __init__(self, tenant):
+        self.tenant = tenant
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.batches = self.ops = 0
+        self.closed = False
+        self.current = []
+
+    def submit(self, fn, *args):
+        with self.lock:
+            if self.closed: raise WriteBusy()
+            if self.thread is None:
+                # started on first use, i.e. after gunicorn has forked
+                self.thread = threading.Thread(target=self.run, args=(self.queue,), name='write-queue', daemon=True)
+                self.thread.start()
+            fut = Future()
+            self.queue.put((fut, fn, args))
+        return fut
+
+    def stop(self, close=False):
+        # the thread drains what is already queued, then exits; a later submit starts a fresh one unless closed
+        with self.lock:
+            if self.thread: self.queue.put(None)
+            self.queue, self.thread = queue.Queue(), None
+            self.closed = close
+
+    @staticmethod
+    def take(q):
+        # whatever piled up during the previous commit, plus up to WRITE_BATCH_MS of stragglers
+        batch = [q.get()]
+        deadline = time.monotonic() + app.config['WRITE_BATCH_MS'] / 1000
+        while batch[-1] is not None and len(batch) < app.config['WRITE_BATCH_SIZE']:
+            try:
+                batch.append(q.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self, q):
+        try:
+            with app.app_context():
+                g.tenant = self.tenant
+                conn = open_db_connection()
+                try:
+                    while self.step(conn, self.take(q)): pass
+                finally:
+                    conn.close()
+        except Exception as e:
+            # detach the dead thread so the next submit starts a new one, then fail whatever was left waiting on it
+            app.logger.exception('write queue stopped')
+            with self.lock:
+                if self.queue is q: self.queue, self.thread = queue.Queue(), None
+            for fut, _, _ in self.current:
+                if not fut.done(): fut.set_exception(e)
+            while True:
+                try:
+                    item = q.get_nowait()
+                except queue.Empty:
+                    break
+                if item and item[0].set_running_or_notify_cancel(): item[0].set_exception(e)
+
+    def step(self, conn, batch):
+        stop = batch[-1] is None
+        if stop: batch.pop()
+        # callers that gave up waiting cancelled their futures; those writes are dropped, not applied
+        batch = self.current = [item for item in batch if item[0].set_running_or_notify_cancel()]
+        if batch:
+            try:
+                results = run_immediate(conn, self.apply, batch)
+            except Exception as e:
+                results = [(False, e)] * len(batch)
+            # futures resolve only after the commit, so callers never act on writes that could still roll back
+            for (fut, _, _), (ok, res) in zip(batch, results):
+                if ok: fut.set_result(res)
+                else: fut.set_exception(res)
+            with self.lock:
+                self.batches += 1
+                self.ops += len(batch)
+        self.current = []
+        return not stop
+
+    @staticmethod
+    def apply(conn, batch):
+        results = []
+        for _, fn, args in batch:
+            conn.execute('SAVEPOINT item')
+            try:
+                res = fn(conn, *args)
+                conn.execute('RELEASE item')
+                results.append((True, res))
+            except Exception as e:
+                conn.execute('ROLLBACK TO item'); conn.execute('RELEASE item')
+                results.append((False, e))
+        return results
+
+
+def run_write(conn, fn, *args):
+    # same contract as run_immediate; with WRITE_QUEUE on, the transaction is shared with other requests' writes
+    if not app.config['WRITE_QUEUE']: return run_immediate(conn, fn, *args)
+    fut = conn.tenant.write_queue.submit(fn, *args)
+    try:
+        return fut.result(timeout=app.config['WRITE_TIMEOUT'])
+    except TimeoutError:
+        # still queued: cancel and report busy; already in the writer's transaction: its outcome is the answer
+        if fut.cancel(): raise WriteBusy()
+        return fut.result()
+
+
+class Tenant:
+    # one school: its database file, idle pooled connections and every in-process cache built from that database
+    def __init__(self, name, path):
+        self.name, self.db_path = name, path
+        self.pool, self.pool_lock = [], threading.Lock()
+        self.principals = PrincipalCache(app.config['PRINCIPAL_CACHE_SIZE'], app.config['PRINCIPAL_CACHE_TTL'])
+        self.students = StudentDirectory()
+        self.menu_cache, self.menu_cache_lock, self.menu_cache_expires = {}, threading.Lock(), 0
+        self.dish_index, self.dish_index_lock = None, threading.Lock()
+        self.rankings, self.rankings_lock = None, threading.Lock()
+        self.ledger_unmaterialized = 0
+        self.write_queue = WriteQueue(self)
+        self.closed = False
+
+    def open(self):
+        migrate(self.db_path)
+        conn = open_db_connection(tenant=self)
+        self.students.warm(conn)
+        conn.close()
+        return self
+
+    def close(self):
+        # connections checked out by running requests are closed when they come back
+        self.write_queue.stop(close=True)
+        with self.pool_lock:
+            self.closed = True
+            conns, self.pool = self.pool, []
+        for conn in conns: sqlite3.Connection.close(conn)
+
+
+class TenantPool:
+    # open schools in LRU order; past TENANT_POOL_SIZE the least recently used one is closed and reopened on demand
+    def __init__(self):
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.opened = self.evicted = 0
+
+    def get(self, name):
+        with self.lock:
+            tenant = self.items.get(name)
+            if tenant:
+                self.items.move_to_end(name)
+                return tenant
+        path = tenant_path(name, app.config['TENANTS_DIR'])
+        if not os.path.exists(path): return None
+        # migrating and warming happen outside the lock; if two requests race, the loser's copy is dropped
+        tenant, evicted = Tenant(name, path).open(), []
+        with self.lock:
+            if name in self.items:
+                evicted.append(tenant)
+                tenant = self.items[name]
+            else:
+                self.items[name] = tenant
+                self.opened += 1
+                while len(self.items) > app.config['TENANT_POOL_SIZE']:
+                    evicted.append(self.items.popitem(last=False)[1])
+                    self.evicted += 1
+        for t in evicted: t.close()
+        return tenant
+
+    def all(self):
+        with self.lock: return list(self.items.values())
+
+
+default_tenant = Tenant('default', db_path)
+tenants = TenantPool()
+# endpoints that work without a school: static files and the process probes
+TENANT_FREE_ENDPOINTS = {'serve_css', 'serve_js', 'serve_assets', 'static', 'healthz', 'readyz', 'metrics'}
+TENANT_PREFIX_RE = re.compile(r'/t/([a-z0-9][a-z0-9-]{0,31})(?=/|$)')
+
+
+def current_tenant():
+    return g.get('tenant') or default_tenant if has_app_context() else default_tenant
+
+
+def all_tenants():
+    return tenants.all() if app.config['TENANTS_DIR'] else [default_tenant]
+
+
+class TenantPrefix:
+    # /t/<school>/... is served as /... with the school noted in the environ; the pages' own /api/... calls
+    # carry no prefix and are routed by the school remembered in the session
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        m = TENANT_PREFIX_RE.match(environ.get('PATH_INFO', ''))
+        if m:
+            environ['canteen.tenant'] = m.group(1)
+            environ['PATH_INFO'] = environ['PATH_INFO'][m.end():] or '/'
+        return self.wsgi_app(environ, start_response)
+
+
+app.wsgi_app = TenantPrefix(app.wsgi_app)
+
+
+@app.before_request
+def resolve_tenant():
+    # school from the subdomain (<school>.TENANT_DOMAIN), then a /t/<school> prefix, then the session
+    if not app.config['TENANTS_DIR']: return
+    host, domain = flask_request.host.split(':')[0], app.config['TENANT_DOMAIN']
+    name = (host[:-len(domain) - 1] if domain and host.endswith('.' + domain) else None) or \
+        flask_request.environ.get('canteen.tenant') or session.get('tenant')
+    tenant = tenants.get(name) if name and TENANT_RE.fullmatch(name) else None
+    if tenant is None:
+        if flask_request.endpoint in TENANT_FREE_ENDPOINTS: return
+        return jsonify({'status': 'error', 'message': 'Школа не найдена'}), 404
+    g.tenant = tenant
+    if session.get('tenant') != tenant.name:
+        # user ids in the session belong to the other school's database
+        session.clear()
+        session['tenant'] = tenant.name
+
+
+def place_order(conn, user_id, menu_id):
+    menu = conn.execute(
+        'SELECT m.id, m.meal_type, m.max_portions, d.id as dish_id, d.price FROM menu m JOIN dishes d ON m.dish_id=d.id WHERE m.id=?',
+        (menu_id,)).fetchone()
+    if not menu: raise OrderError('Нет в наличии')
+    if menu['max_portions'] is not None and conn.execute('SELECT COUNT(*) FROM orders WHERE menu_id=?', (menu_id,)).fetchone()[0] >= menu['max_portions']:
+        raise OrderError('Порции закончились')
+    user = conn.execute('SELECT subscription_end_date FROM users WHERE id=?', (user_id,)).fetchone()
+    if not user: raise OrderError('Ученик не найден')
+    paid = 1 if subscription_active(user['subscription_end_date']) else 0
+    if not conn.execute('UPDATE dishes SET current_stock = current_stock - 1 WHERE id=? AND current_stock > 0',
+                        (menu['dish_id'],)).rowcount: raise OrderError('Нет в наличии')
+    try:
+        cur = conn.execute(
+            'INSERT INTO orders (user_id, menu_id, order_date, paid, collected) VALUES (?, ?, datetime("now","localtime"), ?, 0)',
+            (user_id, menu_id, paid))
+    except sqlite3.IntegrityError:
+        raise OrderError('Уже заказано')
+    conn.execute('UPDATE users SET orders_count = orders_count + 1 WHERE id=?', (user_id,))
+    if not paid:
+        pid = conn.execute(
+            'INSERT INTO payments (user_id, amount, type, order_id, status) VALUES (?, ?, "single", ?, "completed")',
+            (user_id, menu['price'], cur.lastrowid)).lastrowid
+        if not post_ledger(conn, user_id, -to_cents(menu['price']), 'order', pid): raise OrderError('Мало средств')
+        bump_payments(conn, menu['price'])
+    bump_stats(conn, date.today().isoformat(), menu['meal_type'], menu['dish_id'], orders=1, sold=paid,
+               revenue=0 if paid else menu['price'])
+    return menu
+
+
+def issue_dish(conn, user_id, dish_id, issued=None):
+    # issued: a list the bulk issue collects the served order ids in, to book them with one bump_issued()
+    today = date.today().isoformat()
+    menu = conn.execute('SELECT id, meal_type, max_portions FROM menu WHERE date=? AND dish_id=?', (today, dish_id)).fetchone()
+    mid, meal_type = (menu['id'], menu['meal_type']) if menu else (conn.execute(
+        "INSERT INTO menu (date, meal_type, dish_id, max_portions) VALUES (?, 'lunch', ?, NULL)", (today, dish_id)).lastrowid, 'lunch')
+    # a pre-ordered portion was already taken from stock when the order was placed
+    pre = conn.execute('SELECT id FROM orders WHERE user_id=? AND menu_id=? AND collected=0', (user_id, mid)).fetchone()
+    if pre:
+        conn.execute('UPDATE orders SET collected=1 WHERE id=?', (pre['id'],))
+        if issued is None: bump_issued(conn, [pre['id']])
+        else: issued.append(pre['id'])
+    else:
+        # a walk-in portion counts against the cap like a pre-order; collecting a pre-order never does
+        if menu and menu['max_portions'] is not None and conn.execute('SELECT COUNT(*) FROM orders WHERE menu_id=?', (mid,)).fetchone()[0] >= menu['max_portions']:
+            raise OrderError('Порции закончились')
+        if not conn.execute('UPDATE dishes SET current_stock = current_stock - 1 WHERE id=? AND current_stock > 0',
+                            (dish_id,)).rowcount: raise OrderError('Нет в наличии')
+        try:
+            oid = conn.execute(
+                'INSERT INTO orders (user_id, menu_id, order_date, paid, collected) VALUES (?, ?, datetime("now","localtime"), 1, 1)',
+                (user_id, mid)).lastrowid
+        except sqlite3.IntegrityError:
+            raise OrderError('Уже выдано')
+        conn.execute('UPDATE users SET orders_count = orders_count + 1 WHERE id=?', (user_id,))
+        if issued is None:
+            bump_stats(conn, today, meal_type, dish_id, orders=1, sold=1, issued=1)
+            consume_ingredients(conn, {dish_id: 1})
+        else:
+            bump_stats(conn, today, meal_type, dish_id, orders=1, sold=1)
+            issued.append(oid)
+    return conn.execute('SELECT current_stock FROM dishes WHERE id=?', (dish_id,)).fetchone()['current_stock']
 
 
 @app.route('/')
@@ -80,22 +1065,102 @@ def admin_dashboard(): return redirect('/login') if 'user_id' not in session els
 
 
 @app.route('/logout')
-def logout(): session.clear(); return redirect('/login')
+def logout():
+    tenant = session.get('tenant')
+    session.clear()
+    if tenant: session['tenant'] = tenant
+    return redirect('/login')
+
+
+STATIC_DIRS = ('css', 'js', 'assets')
+PRECOMPRESS_EXTENSIONS = ('.css', '.js', '.svg', '.html', '.json')
+
+
+def static_files():
+    for sub in STATIC_DIRS:
+        for root, _, files in os.walk(os.path.join(frontend_dir, sub)):
+            for f in sorted(files):
+                if not f.endswith(('.gz', '.br')): yield os.path.join(root, f)
+
+
+def compute_static_version():
+    h = hashlib.md5()
+    for path in static_files(): h.update(f'{path}:{os.path.getmtime(path)}'.encode())
+    return h.hexdigest()[:10]
+
+
+def precompress_static():
+    encoders = [('.gz', lambda b: gzip.compress(b, 9, mtime=0))] + ([('.br', brotli.compress)] if brotli else [])
+    for path in static_files():
+        if not path.endswith(PRECOMPRESS_EXTENSIONS): continue
+        data = None
+        for ext, compress in encoders:
+            if os.path.exists(path + ext) and os.path.getmtime(path + ext) >= os.path.getmtime(path): continue
+            if data is None:
+                with open(path, 'rb') as f: data = f.read()
+            with open(path + ext, 'wb') as f: f.write(compress(data))
+
+
+static_version = compute_static_version()
+
+
+@app.context_processor
+def inject_static_version():
+    return {'static_version': static_version}
+
+
+def send_static(sub, filename):
+    # ?v=<static_version> URLs change on every deploy, so they can be cached forever
+    folder = os.path.join(frontend_dir, sub)
+    max_age = app.config['STATIC_MAX_AGE'] if flask_request.args.get('v') else 3600
+    resp = None
+    for encoding, ext in (('br', '.br'), ('gzip', '.gz')):
+        if flask_request.accept_encodings[encoding] and os.path.isfile(os.path.join(folder, filename + ext)):
+            resp = send_from_directory(folder, filename + ext, mimetype=mimetypes.guess_type(filename)[0],
+                                       max_age=max_age)
+            resp.headers['Content-Encoding'] = encoding
+            del resp.headers['Content-Disposition']
+            break
+    if resp is None: resp = send_from_directory(folder, filename, max_age=max_age)
+    resp.vary.add('Accept-Encoding')
+    if flask_request.args.get('v'): resp.cache_control.immutable = True
+    return resp
 
 
 @app.route('/css/<path:filename>')
 def serve_css(filename):
-    return send_from_directory(os.path.join(frontend_dir, 'css'), filename)
+    return send_static('css', filename)
 
 
 @app.route('/js/<path:filename>')
 def serve_js(filename):
-    return send_from_directory(os.path.join(frontend_dir, 'js'), filename)
+    return send_static('js', filename)
 
 
 @app.route('/assets/<path:filename>')
 def serve_assets(filename):
-    return send_from_directory(os.path.join(frontend_dir, 'assets'), filename)
+    return send_static('assets', filename)
+
+
+@app.route('/healthz')
+def healthz():
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/readyz')
+def readyz():
+    if shutting_down.is_set(): return jsonify({'status': 'shutting_down'}), 503
+    if app.config['TENANTS_DIR'] and 'tenant' not in g:
+        if not os.path.isdir(app.config['TENANTS_DIR']): return jsonify({'status': 'error', 'message': 'no tenants'}), 503
+        return jsonify({'status': 'ready', 'tenants_open': len(tenants.all())})
+    try:
+        conn = get_db_connection()
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        conn.close()
+    except sqlite3.Error as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 503
+    if version < len(MIGRATIONS): return jsonify({'status': 'migrating', 'schema_version': version}), 503
+    return jsonify({'status': 'ready', 'schema_version': version})
 
 
 @app.route('/api/login', methods=['POST'])
@@ -103,11 +1168,31 @@ def api_login():
     data = flask_request.get_json()
     u = data.get('username', '').strip()
     p = data.get('password')
+    wait = login_buckets.take((current_tenant().name, normalize_ident(u)))
+    if wait:
+        resp = jsonify({'status': 'error', 'message': 'Слишком много попыток, подождите'})
+        resp.headers['Retry-After'] = str(math.ceil(wait))
+        return resp, 429
     conn = get_db_connection()
     user = conn.execute('SELECT * FROM users WHERE id=?', (int(u),)).fetchone() if u.isdigit() else conn.execute(
-        'SELECT * FROM users WHERE email=? OR username=?', (u, u)).fetchone()
+        LOGIN_USER, (u, u)).fetchone()
     conn.close()
-    if user and check_password_hash(user['password_hash'], p):
+    try:
+        ok = user and p and verify_password(user['password_hash'], p)
+    except HashBusy:
+        return jsonify({'status': 'error', 'message': 'Сервер занят, повторите вход'}), 503
+    if ok and needs_rehash(user['password_hash']):
+        # upgrade to the configured work factor while we have the plaintext; skipped when the pool is saturated
+        try:
+            new_hash = hash_password(p)
+            conn = get_db_connection()
+            conn.execute('UPDATE users SET password_hash=? WHERE id=? AND password_hash=?',
+                         (new_hash, user['id'], user['password_hash']))
+            conn.commit()
+            conn.close()
+        except HashBusy:
+            pass
+    if ok:
         session['user_id'] = user['id'];
         session['role'] = user['role']
         return jsonify({'status': 'success', 'redirect': f"/{user['role']}"})
@@ -121,9 +1206,13 @@ def api_register():
     if conn.execute('SELECT id FROM users WHERE email=?', (data['email'],)).fetchone():
         conn.close();
         return jsonify({'status': 'error', 'message': 'Email занят'}), 400
+    try:
+        pw_hash = hash_password(data['password'])
+    except HashBusy:
+        conn.close(); return jsonify({'status': 'error', 'message': 'Сервер занят, повторите'}), 503
     try:
         cur = conn.execute('INSERT INTO users (username, email, password_hash, role, balance) VALUES (?, ?, ?, ?, 0)',
-                           (data['username'], data['email'], generate_password_hash(data['password']), 'student'))
+                           (data['username'], data['email'], pw_hash, 'student'))
         uid = cur.lastrowid
         for aid in data.get('allergens', []): conn.execute(
             'INSERT INTO allergens (user_id, ingredient_id) VALUES (?, ?)', (uid, aid))
@@ -131,6 +1220,7 @@ def api_register():
     except:
         conn.close(); return jsonify({'status': 'error', 'message': 'Ошибка'}), 500
     conn.close();
+    current_tenant().students.add(uid, data['username'], data['email'], 'student')
     session['user_id'] = uid;
     session['role'] = 'student'
     return jsonify({'status': 'success', 'redirect': '/student'})
@@ -139,14 +1229,15 @@ def api_register():
 @app.route('/api/user/profile', methods=['GET'])
 def get_profile():
     if 'user_id' not in session: return jsonify({'status': 'error'}), 401
+    u = get_principal(session['user_id'])
+    if not u: return jsonify({'status': 'error'}), 401
     conn = get_db_connection()
-    u = conn.execute('SELECT * FROM users WHERE id=?', (session['user_id'],)).fetchone()
     algs = conn.execute(
         'SELECT i.id, i.name FROM allergens a JOIN ingredients i ON a.ingredient_id=i.id WHERE user_id=?',
         (session['user_id'],)).fetchall()
     conn.close()
     return jsonify({'status': 'success', 'user': {
-        'id': u['id'], 'formatted_id': format_user_id(u['id']), 'username': u['username'],
+        'id': u['id'], 'formatted_id': format_user_id(u['id']), 'qr_token': student_token(u['id']), 'username': u['username'],
         'email': u['email'], 'role': u['role'], 'balance': u['balance'],
         'has_active_subscription': check_subscription(u['id']), 'subscription_end_date': u['subscription_end_date']
     }, 'allergens': [dict(r) for r in algs]})
@@ -156,46 +1247,167 @@ def get_profile():
 def topup():
     if 'user_id' not in session: return jsonify({'status': 'error'}), 401
     amt = flask_request.get_json().get('amount')
+    try:
+        cents = to_cents(amt)
+    except Exception:
+        cents = 0
+    if cents <= 0: return jsonify({'status': 'error', 'message': 'Неверная сумма'}), 400
     conn = get_db_connection()
-    conn.execute('UPDATE users SET balance = balance + ? WHERE id=?', (amt, session['user_id']))
-    conn.execute('INSERT INTO payments (user_id, amount, type, status) VALUES (?, ?, "topup", "completed")',
-                 (session['user_id'], amt))
+    pid = conn.execute('INSERT INTO payments (user_id, amount, type, status) VALUES (?, ?, "topup", "completed")',
+                       (session['user_id'], cents / 100)).lastrowid
+    post_ledger(conn, session['user_id'], cents, 'topup', pid)
+    bump_payments(conn, cents / 100)
     conn.commit();
     conn.close();
+    invalidate_principal(session['user_id'])
     return jsonify({'status': 'success'})
 
 
+def subscribe(conn, user_id):
+    pid = conn.execute('INSERT INTO payments (user_id, amount, type, status) VALUES (?, 1500, "subscription", "completed")',
+                       (user_id,)).lastrowid
+    if not post_ledger(conn, user_id, -150000, 'subscription', pid): raise OrderError('Мало средств')
+    conn.execute('UPDATE users SET subscription_end_date=? WHERE id=?',
+                 ((date.today() + timedelta(days=30)).isoformat(), user_id))
+    bump_payments(conn, 1500)
+
+
 @app.route('/api/payments/subscription', methods=['POST'])
 def buy_sub():
     if 'user_id' not in session: return jsonify({'status': 'error'}), 401
     conn = get_db_connection()
-    u = conn.execute('SELECT balance FROM users WHERE id=?', (session['user_id'],)).fetchone()
-    if u['balance'] < 1500: conn.close(); return jsonify({'status': 'error', 'message': 'Мало средств'}), 400
-    conn.execute('UPDATE users SET balance = balance - 1500, subscription_end_date=? WHERE id=?',
-                 ((date.today() + timedelta(days=30)).isoformat(), session['user_id']))
-    conn.execute('INSERT INTO payments (user_id, amount, type, status) VALUES (?, 1500, "subscription", "completed")',
-                 (session['user_id'],))
-    conn.commit();
+    try:
+        run_immediate(conn, subscribe, session['user_id'])
+    except OrderError as e:
+        conn.close(); return jsonify({'status': 'error', 'message': str(e)}), 400
     conn.close();
+    invalidate_principal(session['user_id'])
     return jsonify({'status': 'success'})
 
 
-@app.route('/api/menu/today', methods=['GET'])
-def get_menu():
-    conn = get_db_connection()
-    items = conn.execute(
-        'SELECT m.id, m.meal_type, m.dish_id, d.name as dish_name, d.calories, d.price, d.current_stock FROM menu m JOIN dishes d ON m.dish_id=d.id WHERE m.date=?',
-        (date.today().isoformat(),)).fetchall()
+def invalidate_menu_cache():
+    tenant = current_tenant()
+    with tenant.menu_cache_lock: tenant.menu_cache.clear()
+
+
+def invalidate_dish_index():
+    tenant = current_tenant()
+    with tenant.dish_index_lock: tenant.dish_index = None
+    invalidate_menu_cache()
+
+
+def dish_index(conn):
+    # dish_id -> frozenset of ingredient ids, rebuilt only when dish_ingredients changes
+    tenant = conn.tenant
+    with tenant.dish_index_lock:
+        if tenant.dish_index is None:
+            index = {}
+            for dish_id, ing_id in conn.execute('SELECT dish_id, ingredient_id FROM dish_ingredients'):
+                index.setdefault(dish_id, set()).add(ing_id)
+            tenant.dish_index = {k: frozenset(v) for k, v in index.items()}
+        return tenant.dish_index
+
+
+NO_RANKING = {'reviews': 0, 'rating': None, 'score': None, 'popularity': {}}
+
+
+def popularity_stale(refreshed):
+    return time.time() - refreshed >= app.config['POPULARITY_REFRESH'] or date.fromtimestamp(refreshed) != date.today()
+
+
+def refresh_popularity(conn):
+    # checked again under the write lock, so concurrent workers rebuild the rankings once per period
+    last = conn.execute("SELECT value FROM stats_totals WHERE name='popularity_refreshed'").fetchone()
+    if last and not popularity_stale(last[0]): return
+    for sql in REFRESH_POPULARITY: conn.execute(sql)
+
+
+def invalidate_rankings():
+    tenant = current_tenant()
+    with tenant.rankings_lock: tenant.rankings = None
+
+
+def dish_rankings(conn):
+    # dish_id -> review count, mean and Bayesian score (mean pulled towards the overall mean by RATING_PRIOR
+    # virtual reviews) plus orders and rank per window; read from dish_ratings / dish_popularity and kept
+    # in-process for POPULARITY_REFRESH seconds or until the next review
+    tenant = conn.tenant
+    with tenant.rankings_lock:
+        if tenant.rankings and tenant.rankings[0] > time.monotonic(): return tenant.rankings[1]
+    last = conn.execute("SELECT value FROM stats_totals WHERE name='popularity_refreshed'").fetchone()
+    if not last or popularity_stale(last[0]): run_immediate(conn, refresh_popularity)
+    total, total_sum = conn.execute('SELECT SUM(reviews), SUM(rating_sum) FROM dish_ratings').fetchone()
+    prior, mean = app.config['RATING_PRIOR'], total_sum / total if total else 0
+    res = {}
+    for r in conn.execute('SELECT dish_id, reviews, rating_sum FROM dish_ratings WHERE reviews > 0'):
+        res[r['dish_id']] = {'reviews': r['reviews'], 'rating': round(r['rating_sum'] / r['reviews'], 2),
+                             'score': round((prior * mean + r['rating_sum']) / (prior + r['reviews']), 2), 'popularity': {}}
+    for r in conn.execute('SELECT period, dish_id, orders, rank FROM dish_popularity'):
+        res.setdefault(r['dish_id'], dict(NO_RANKING, popularity={}))['popularity'][r['period']] = {
+            'orders': r['orders'], 'rank': r['rank']}
+    with tenant.rankings_lock: tenant.rankings = (time.monotonic() + app.config['POPULARITY_REFRESH'], res)
+    return res
+
+
+def assemble_menu(conn, day):
+    items = conn.execute(MENU_FOR_DAY, (day,)).fetchall()
+    ings = {}
+    for r in conn.execute(
+            'SELECT di.dish_id, i.id, i.name FROM dish_ingredients di JOIN ingredients i ON di.ingredient_id=i.id WHERE di.dish_id IN (SELECT dish_id FROM menu WHERE date=?) ORDER BY di.dish_id, i.id',
+            (day,)):
+        ings.setdefault(r['dish_id'], []).append({'id': r['id'], 'name': r['name']})
+    rankings = dish_rankings(conn)
     res = {'breakfast': [], 'lunch': []}
     for item in items:
         d = dict(item)
-        ings = conn.execute(
-            'SELECT i.id, i.name FROM dish_ingredients di JOIN ingredients i ON di.ingredient_id=i.id WHERE di.dish_id=?',
-            (d['dish_id'],)).fetchall()
-        d['ingredients'] = [dict(i) for i in ings]
+        d['ingredients'] = ings.get(d['dish_id'], [])
+        d.update(rankings.get(d['dish_id'], NO_RANKING))
         res[d['meal_type']].append(d)
-    conn.close();
-    return jsonify(res)
+    return res
+
+
+def personalize_menu(menu, index, allergens, safe_only):
+    res = {}
+    for meal, items in menu.items():
+        res[meal] = []
+        for item in items:
+            conflicts = sorted(index.get(item['dish_id'], frozenset()) & allergens)
+            if safe_only and conflicts: continue
+            res[meal].append(dict(item, safe=not conflicts, conflicts=conflicts))
+    return res
+
+
+@app.route('/api/menu/today', methods=['GET'])
+def get_menu():
+    # Shared menu plus a per-allergen-set overlay; most students share the empty set, so bodies stay cached
+    day = date.today().isoformat()
+    u = get_principal(session['user_id']) if 'user_id' in session else None
+    allergens = u['allergens'] if u else frozenset()
+    safe_only = flask_request.args.get('safe') == '1'
+    key = (day, allergens, safe_only)
+    tenant = current_tenant()
+    with tenant.menu_cache_lock:
+        # writes in other worker processes don't reach invalidate_menu_cache(), so entries also expire after MENU_CACHE_TTL;
+        # orders and issues don't invalidate at all, the stock shown may lag by up to MENU_CACHE_TTL
+        if tenant.menu_cache_expires <= time.monotonic():
+            tenant.menu_cache.clear()
+            tenant.menu_cache_expires = time.monotonic() + app.config['MENU_CACHE_TTL']
+            with tenant.dish_index_lock: tenant.dish_index = None
+        cached = tenant.menu_cache.get(key)
+    if cached is None:
+        conn = get_db_connection()
+        with tenant.menu_cache_lock: menu = tenant.menu_cache.get(day)
+        if menu is None:
+            menu = assemble_menu(conn, day)
+            with tenant.menu_cache_lock: tenant.menu_cache[day] = menu
+        body = jsonify(personalize_menu(menu, dish_index(conn), allergens, safe_only)).get_data()
+        conn.close()
+        cached = (body, hashlib.md5(body).hexdigest())
+        with tenant.menu_cache_lock: tenant.menu_cache[key] = cached
+    resp = app.response_class(cached[0], mimetype='application/json')
+    resp.set_etag(cached[1])
+    resp.headers['Vary'] = 'Cookie'
+    return resp.make_conditional(flask_request)
 
 
 @app.route('/api/orders', methods=['POST'])
@@ -203,46 +1415,31 @@ def create_order():
     if 'user_id' not in session: return jsonify({'status': 'error'}), 401
     data = flask_request.get_json()
     conn = get_db_connection()
-    menu = conn.execute(
-        'SELECT m.*, d.current_stock, d.price, d.id as dish_id FROM menu m JOIN dishes d ON m.dish_id=d.id WHERE m.id=?',
-        (data['menu_id'],)).fetchone()
-    if not menu or menu['current_stock'] <= 0: conn.close(); return jsonify(
-        {'status': 'error', 'message': 'Нет в наличии'}), 400
-    if conn.execute('SELECT id FROM orders WHERE user_id=? AND menu_id=?',
-                    (session['user_id'], data['menu_id'])).fetchone(): conn.close(); return jsonify(
-        {'status': 'error', 'message': 'Уже заказано'}), 400
-
-    paid = 1 if check_subscription(session['user_id']) else 0
-    if not paid:
-        user = conn.execute('SELECT balance FROM users WHERE id=?', (session['user_id'],)).fetchone()
-        if user['balance'] < menu['price']: conn.close(); return jsonify(
-            {'status': 'error', 'message': 'Мало средств'}), 400
-        conn.execute('UPDATE users SET balance = balance - ? WHERE id=?', (menu['price'], session['user_id']))
-
     try:
-        conn.execute('UPDATE dishes SET current_stock = current_stock - 1 WHERE id=?', (menu['dish_id'],))
-        cur = conn.execute(
-            'INSERT INTO orders (user_id, menu_id, order_date, paid, collected) VALUES (?, ?, datetime("now","localtime"), ?, 0)',
-            (session['user_id'], data['menu_id'], paid))
-        if not paid: conn.execute(
-            'INSERT INTO payments (user_id, amount, type, order_id, status) VALUES (?, ?, "single", ?, "completed")',
-            (session['user_id'], menu['price'], cur.lastrowid))
-        conn.commit()
+        menu = run_write(conn, place_order, session['user_id'], data['menu_id'])
+    except OrderError as e:
+        conn.close(); return jsonify({'status': 'error', 'message': str(e)}), 400
+    except WriteBusy:
+        conn.close(); return jsonify({'status': 'error', 'message': 'Сервер занят, повторите'}), 503
     except Exception as e:
         conn.close(); return jsonify({'status': 'error', 'message': str(e)}), 500
     conn.close();
+    invalidate_principal(session['user_id'])
+    publish_event('order', {'menu_id': menu['id'], 'dish_id': menu['dish_id'], 'meal_type': menu['meal_type']}, role='cook')
     return jsonify({'status': 'success', 'message': 'Заказ создан'})
 
 
 @app.route('/api/orders/my', methods=['GET'])
 def get_my_orders():
     if 'user_id' not in session: return jsonify({'status': 'error'}), 401
+    after, limit = page_args(50, pair=True)
+    cond, params = '', [session['user_id']]
+    if after:
+        cond, params = ' AND (o.order_date, o.id) < (?, ?)', params + list(after)
     conn = get_db_connection()
-    orders = conn.execute(
-        'SELECT o.id, o.order_date as date, d.name as dish_name, d.price, o.paid, o.collected, d.id as dish_id FROM orders o JOIN menu m ON o.menu_id=m.id JOIN dishes d ON m.dish_id=d.id WHERE o.user_id=? ORDER BY o.order_date DESC',
-        (session['user_id'],)).fetchall()
+    orders = conn.execute(ORDERS_BY_USER.format(orders=history(conn, 'orders'), cond=cond), params + [limit]).fetchall()
     conn.close();
-    return jsonify([dict(o) for o in orders])
+    return paged(orders, limit, lambda o: f"{o['date']},{o['id']}")
 
 
 @app.route('/api/user/allergens', methods=['POST'])
@@ -254,32 +1451,41 @@ def update_allergens():
         'INSERT INTO allergens (user_id, ingredient_id) VALUES (?, ?)', (session['user_id'], aid))
     conn.commit();
     conn.close();
+    invalidate_principal(session['user_id'])
     return jsonify({'status': 'success'})
 
 
 @app.route('/api/reviews', methods=['POST'])
 def add_review():
+    if 'user_id' not in session: return jsonify({'status': 'error'}), 401
     d = flask_request.get_json()
+    try:
+        dish_id, rating = int(d['dish_id']), int(d['rating'])
+    except (KeyError, TypeError, ValueError):
+        rating = 0
+    if not 1 <= rating <= 5: return jsonify({'status': 'error', 'message': 'Оценка от 1 до 5'}), 400
     conn = get_db_connection();
     conn.execute('INSERT INTO reviews (user_id, dish_id, rating, comment) VALUES (?, ?, ?, ?)',
-                 (session['user_id'], d['dish_id'], d['rating'], d['comment']));
+                 (session['user_id'], dish_id, rating, d.get('comment')));
+    conn.execute('INSERT INTO dish_ratings (dish_id, reviews, rating_sum) VALUES (?, 1, ?) ON CONFLICT(dish_id) DO UPDATE SET reviews=reviews+1, rating_sum=rating_sum+excluded.rating_sum',
+                 (dish_id, rating))
     conn.commit();
     conn.close();
+    invalidate_rankings()
+    invalidate_menu_cache()
     return jsonify({'status': 'success'})
 
 
 @app.route('/api/dishes', methods=['GET'])
 def get_dishes():
     conn = get_db_connection()
-    dishes = conn.execute('SELECT * FROM dishes').fetchall()
+    dishes = conn.execute(DISHES_RESERVED).fetchall()
+    rankings = dish_rankings(conn)
     res = []
     for d in dishes:
         dish = dict(d);
         dish['stock_quantity'] = dish['current_stock']
-        c = conn.execute(
-            "SELECT COUNT(o.id) as c FROM orders o JOIN menu m ON o.menu_id=m.id WHERE m.dish_id=? AND o.collected=0 AND date(o.order_date)=date('now','localtime')",
-            (dish['id'],)).fetchone()['c']
-        dish['reserved'] = c
+        dish.update(rankings.get(dish['id'], NO_RANKING))
         res.append(dish)
     conn.close();
     return jsonify(res)
@@ -290,7 +1496,7 @@ def get_ingr():
     conn = get_db_connection();
     ings = conn.execute('SELECT * FROM ingredients').fetchall();
     conn.close();
-    return jsonify([dict(i) for i in ings])
+    return jsonify(ings)
 
 @app.route('/api/inventory/update', methods=['POST'])
 def update_inv():
@@ -310,6 +1516,7 @@ def update_inv():
     except Exception as e:
         conn.close(); return jsonify({'status': 'error', 'message': str(e)}), 500
     conn.close();
+    invalidate_menu_cache()
     return jsonify({'status': 'success'})
 
 
@@ -319,57 +1526,124 @@ def issue_meal():
     dish_id = d.get('dish_id');
     ident = str(d.get('student_identifier')).strip()
     conn = get_db_connection()
-    dish = conn.execute('SELECT * FROM dishes WHERE id=?', (dish_id,)).fetchone()
-    if not dish or dish['current_stock'] <= 0: conn.close(); return jsonify(
+    dish = conn.execute('SELECT id FROM dishes WHERE id=?', (dish_id,)).fetchone()
+    if not dish: conn.close(); return jsonify(
         {'status': 'error', 'message': 'Нет в наличии'}), 400
 
-    student = conn.execute('SELECT id, username FROM users WHERE id=?',
-                           (int(ident),)).fetchone() if ident.isdigit() else conn.execute(
-        'SELECT id, username FROM users WHERE email=? OR username=?', (ident, ident)).fetchone()
+    student = find_student(conn, ident)
     if not student: conn.close(); return jsonify({'status': 'error', 'message': 'Ученик не найден'}), 404
 
     try:
-        conn.execute('UPDATE dishes SET current_stock = current_stock - 1 WHERE id=?', (dish_id,))
-        today = date.today().isoformat()
-        menu = conn.execute('SELECT id FROM menu WHERE date=? AND dish_id=?', (today, dish_id)).fetchone()
-        mid = menu['id'] if menu else conn.execute("INSERT INTO menu (date, meal_type, dish_id) VALUES (?, 'lunch', ?)",
-                                                   (today, dish_id)).lastrowid
-        conn.execute(
-            'INSERT INTO orders (user_id, menu_id, order_date, paid, collected) VALUES (?, ?, datetime("now","localtime"), 1, 1)',
-            (student['id'], mid))
-        conn.commit()
+        new_stock = run_write(conn, issue_dish, student['id'], dish_id)
+    except OrderError as e:
+        conn.close(); return jsonify({'status': 'error', 'message': str(e)}), 400
+    except WriteBusy:
+        conn.close(); return jsonify({'status': 'error', 'message': 'Сервер занят, повторите'}), 503
     except:
         conn.close(); return jsonify({'status': 'error', 'message': 'Ошибка'}), 500
     conn.close();
     return jsonify(
-        {'status': 'success', 'message': f'Выдано {student["username"]}', 'new_stock': dish['current_stock'] - 1})
+        {'status': 'success', 'message': f'Выдано {student["username"]}', 'new_stock': new_stock})
 
 
 @app.route('/api/cook/check_orders', methods=['POST'])
 def check_orders():
     ident = str(flask_request.get_json().get('student_identifier')).strip();
     conn = get_db_connection()
-    student = conn.execute('SELECT id, username FROM users WHERE id=?',
-                           (int(ident),)).fetchone() if ident.isdigit() else conn.execute(
-        'SELECT id, username FROM users WHERE email=? OR username=?', (ident, ident)).fetchone()
+    student = find_student(conn, ident)
     if not student: conn.close(); return jsonify({'status': 'error', 'message': 'Ученик не найден'}), 404
-    orders = conn.execute(
-        "SELECT o.id, d.name as dish_name, d.calories, m.meal_type FROM orders o JOIN menu m ON o.menu_id=m.id JOIN dishes d ON m.dish_id=d.id WHERE o.user_id=? AND o.collected=0 AND date(o.order_date)=date('now','localtime')",
-        (student['id'],)).fetchall()
+    orders = conn.execute(ORDERS_TO_COLLECT, (student['id'],)).fetchall()
     conn.close();
-    return jsonify({'status': 'success', 'student_name': student['username'],
+    return jsonify({'status': 'success', 'student_id': student['id'], 'student_name': student['username'],
                     'student_id_formatted': format_user_id(student['id']), 'orders': [dict(o) for o in orders]})
 
 
 @app.route('/api/cook/finish_order', methods=['POST'])
 def finish_order():
+    oid = flask_request.get_json().get('order_id')
+
+    def finish(c):
+        if c.execute('UPDATE orders SET collected=1 WHERE id=? AND collected=0', (oid,)).rowcount: bump_issued(c, [oid])
+
     conn = get_db_connection();
-    conn.execute('UPDATE orders SET collected=1 WHERE id=?', (flask_request.get_json().get('order_id'),));
-    conn.commit();
+    try:
+        run_write(conn, finish)
+    except WriteBusy:
+        conn.close(); return jsonify({'status': 'error', 'message': 'Сервер занят, повторите'}), 503
     conn.close();
     return jsonify({'status': 'success', 'message': 'Выдано'})
 
 
+@app.route('/api/orders/bulk', methods=['POST'])
+def create_orders_bulk():
+    if session.get('role') not in ['cook', 'admin']: return jsonify({'status': 'error'}), 403
+    d = flask_request.get_json()
+
+    def order(c, uid):
+        place_order(c, uid, d['menu_id'])
+
+    conn = get_db_connection()
+    try:
+        res = run_immediate(conn, run_items, order, [(uid, (uid,)) for uid in d.get('user_ids', [])])
+    except Exception as e:
+        conn.close(); return jsonify({'status': 'error', 'message': str(e)}), 500
+    conn.close();
+    for r in res:
+        if r['status'] == 'success': invalidate_principal(r['id'])
+    if any(r['status'] == 'success' for r in res): publish_event('order', {'menu_id': d['menu_id']}, role='cook')
+    return jsonify({'status': 'success', 'results': res})
+
+
+@app.route('/api/issue_meal/bulk', methods=['POST'])
+def issue_meal_bulk():
+    if session.get('role') not in ['cook', 'admin']: return jsonify({'status': 'error'}), 403
+    d = flask_request.get_json()
+    dish_id = d.get('dish_id')
+
+    def issue(c, ident, issued):
+        student = find_student(c, ident)
+        if not student: raise OrderError('Ученик не найден')
+        return issue_dish(c, student['id'], dish_id, issued)
+
+    def issue_all(c, idents):
+        # the portions of the whole batch are booked together: one stats upsert per menu row, one ingredient update
+        issued = []
+        res = run_items(c, issue, [(i, (str(i).strip(), issued)) for i in idents])
+        bump_issued(c, issued)
+        return res
+
+    conn = get_db_connection()
+    try:
+        res = run_immediate(conn, issue_all, d.get('student_identifiers', []))
+    except Exception as e:
+        conn.close(); return jsonify({'status': 'error', 'message': str(e)}), 500
+    conn.close();
+    return jsonify({'status': 'success', 'results': res})
+
+
+@app.route('/api/cook/finish_orders', methods=['POST'])
+def finish_orders_bulk():
+    if session.get('role') not in ['cook', 'admin']: return jsonify({'status': 'error'}), 403
+    ids = [int(i) for i in flask_request.get_json().get('order_ids', [])]
+
+    def finish(c):
+        found = {r['id']: r['collected'] for r in c.execute(
+            f"SELECT id, collected FROM orders WHERE id IN ({','.join('?' * len(ids))})", ids)} if ids else {}
+        todo = [(i,) for i in ids if found.get(i) == 0]
+        c.executemany('UPDATE orders SET collected=1 WHERE id=?', todo)
+        bump_issued(c, [t[0] for t in todo])
+        return [{'id': i, 'status': 'success'} if found.get(i) == 0 else
+                {'id': i, 'status': 'error', 'message': 'Уже выдано' if i in found else 'Заказ не найден'} for i in ids]
+
+    conn = get_db_connection()
+    try:
+        res = run_immediate(conn, finish)
+    except Exception as e:
+        conn.close(); return jsonify({'status': 'error', 'message': str(e)}), 500
+    conn.close();
+    return jsonify({'status': 'success', 'results': res})
+
+
 @app.route('/api/menu/full', methods=['GET'])
 def get_full_menu():
     conn = get_db_connection();
@@ -377,17 +1651,18 @@ def get_full_menu():
         'SELECT m.id, m.meal_type, d.name as dish_name, d.id as dish_id FROM menu m JOIN dishes d ON m.dish_id=d.id WHERE m.date=?',
         (flask_request.args.get('date', date.today().isoformat()),)).fetchall();
     conn.close()
-    return jsonify([dict(i) for i in items])
+    return jsonify(items)
 
 
 @app.route('/api/menu/add', methods=['POST'])
 def add_menu_item():
     d = flask_request.get_json();
     conn = get_db_connection();
-    conn.execute('INSERT INTO menu (date, meal_type, dish_id) VALUES (?, ?, ?)',
-                 (d['date'], d['meal_type'], d['dish_id']));
+    conn.execute('INSERT INTO menu (date, meal_type, dish_id, max_portions) VALUES (?, ?, ?, ?)',
+                 (d['date'], d['meal_type'], d['dish_id'], d.get('max_portions')));
     conn.commit();
     conn.close();
+    invalidate_menu_cache()
     return jsonify({'status': 'success'})
 
 
@@ -422,26 +1697,118 @@ def del_menu_item(id):
     conn.execute('DELETE FROM menu WHERE id=?', (id,));
     conn.commit();
     conn.close();
+    invalidate_menu_cache()
     return jsonify({'status': 'success'})
 
 
+@app.route('/api/menu/range', methods=['GET'])
+def get_menu_range():
+    # ?from=&to= inclusive, grouped {date: {meal_type: [items]}}; one range scan of idx_menu_date
+    start = flask_request.args.get('from', date.today().isoformat())
+    end = flask_request.args.get('to', start)
+    conn = get_db_connection()
+    rows = conn.execute(
+        'SELECT m.id, m.date, m.meal_type, m.dish_id, d.name as dish_name, m.max_portions, (SELECT COUNT(*) FROM orders o WHERE o.menu_id=m.id) as ordered FROM menu m JOIN dishes d ON m.dish_id=d.id WHERE m.date BETWEEN ? AND ? ORDER BY m.date, m.meal_type, m.id',
+        (start, end)).fetchall()
+    conn.close()
+    res = {}
+    for r in rows:
+        res.setdefault(r['date'], {'breakfast': [], 'lunch': []}).setdefault(r['meal_type'], []).append(dict(r))
+    return jsonify(res)
+
+
+def menu_add(conn, item):
+    if item.get('meal_type') not in ('breakfast', 'lunch'): raise OrderError('Неверный прием пищи')
+    if not conn.execute('SELECT 1 FROM dishes WHERE id=?', (item.get('dish_id'),)).fetchone(): raise OrderError('Блюдо не найдено')
+    return conn.execute('INSERT INTO menu (date, meal_type, dish_id, max_portions) VALUES (?, ?, ?, ?)',
+                        (date.fromisoformat(item['date']).isoformat(), item['meal_type'], item['dish_id'],
+                         item.get('max_portions'))).lastrowid
+
+
+def menu_change(conn, item):
+    # a move re-dates a row (and optionally changes meal type / portion cap); rows with orders stay where they are
+    mid = item['id'] if isinstance(item, dict) else item
+    if conn.execute('SELECT 1 FROM orders WHERE menu_id=? LIMIT 1', (mid,)).fetchone(): raise OrderError('Есть заказы')
+    if not isinstance(item, dict):
+        if not conn.execute('DELETE FROM menu WHERE id=?', (mid,)).rowcount: raise OrderError('Не найдено')
+        return mid
+    if item.get('meal_type', 'lunch') not in ('breakfast', 'lunch'): raise OrderError('Неверный прием пищи')
+    if not conn.execute(
+            'UPDATE menu SET date=COALESCE(?, date), meal_type=COALESCE(?, meal_type), max_portions=COALESCE(?, max_portions) WHERE id=?',
+            (item.get('date') and date.fromisoformat(item['date']).isoformat(), item.get('meal_type'),
+             item.get('max_portions'), mid)).rowcount: raise OrderError('Не найдено')
+    return mid
+
+
+def menu_copy(conn, src, dst, days):
+    # template copy: every row in [src, src + days) lands at the same offset from dst, skipping rows already planned
+    offset = (date.fromisoformat(dst) - date.fromisoformat(src)).days
+    return conn.execute(
+        "INSERT INTO menu (date, meal_type, dish_id, max_portions) SELECT date(m.date, ?), m.meal_type, m.dish_id, m.max_portions FROM menu m WHERE m.date >= ? AND m.date < date(?, ?) AND NOT EXISTS (SELECT 1 FROM menu t WHERE t.date = date(m.date, ?) AND t.meal_type = m.meal_type AND t.dish_id = m.dish_id)",
+        (f'{offset:+d} days', src, src, f'+{days} days', f'{offset:+d} days')).rowcount
+
+
+@app.route('/api/menu/batch', methods=['POST'])
+def menu_batch():
+    # {"add": [{date, meal_type, dish_id, max_portions?}], "delete": [id], "move": [{id, date?, meal_type?, max_portions?}],
+    #  "copy": {"from": date, "to": [date, ...], "days": 7}} -- applied in one transaction, results per item
+    if session.get('role') not in ['cook', 'admin']: return jsonify({'status': 'error'}), 403
+    d = flask_request.get_json()
+    copy = d.get('copy')
+    items = [(f'delete:{i}', (menu_change, i)) for i in d.get('delete', [])] + \
+            [(f'move:{m.get("id")}', (menu_change, m)) for m in d.get('move', [])] + \
+            [(f'add:{n}', (menu_add, a)) for n, a in enumerate(d.get('add', []))]
+    if copy:
+        targets = copy['to'] if isinstance(copy['to'], list) else [copy['to']]
+        items += [(f'copy:{t}', (menu_copy, copy['from'], t, int(copy.get('days', 7)))) for t in targets]
+
+    conn = get_db_connection()
+    try:
+        res = run_immediate(conn, run_items, lambda c, fn, *args: fn(c, *args), items)
+    except (ValueError, KeyError, TypeError) as e:
+        conn.close(); return jsonify({'status': 'error', 'message': f'Неверные данные: {e}'}), 400
+    conn.close()
+    invalidate_menu_cache()
+    return jsonify({'status': 'success', 'results': res})
+
+
 @app.route('/api/purchase_requests', methods=['GET', 'POST'])
 def purchase_reqs():
     conn = get_db_connection()
     if flask_request.method == 'GET':
+        after, limit = page_args(50, pair=True)
+        cond, params = '', []
+        if after:
+            cond, params = 'WHERE (pr.request_date, pr.id) < (?, ?) ', list(after)
         r = conn.execute(
-            'SELECT pr.id, i.name as ingredient_name, pr.quantity, i.unit, pr.status, pr.request_date, u.username as requester FROM purchase_requests pr JOIN ingredients i ON pr.ingredient_id=i.id JOIN users u ON pr.requested_by=u.id ORDER BY pr.request_date DESC LIMIT 50').fetchall()
+            f'SELECT pr.id, i.name as ingredient_name, pr.quantity, i.unit, pr.status, pr.request_date, u.username as requester FROM purchase_requests pr JOIN ingredients i ON pr.ingredient_id=i.id JOIN users u ON pr.requested_by=u.id {cond}ORDER BY pr.request_date DESC, pr.id DESC LIMIT ?',
+            params + [limit]).fetchall()
         conn.close();
-        return jsonify([dict(x) for x in r])
+        return paged(r, limit, lambda x: f"{x['request_date']},{x['id']}")
     d = flask_request.get_json()
     conn.execute(
         'INSERT INTO purchase_requests (ingredient_id, quantity, requested_by, status) VALUES (?, ?, ?, "pending")',
         (d['ingredient_id'], d['quantity'], session['user_id']));
     conn.commit();
+    publish_pending_count(conn)
     conn.close()
     return jsonify({'status': 'success'})
 
 
+@app.route('/api/inventory/forecast', methods=['GET', 'POST'])
+def inventory_forecast():
+    if session.get('role') not in ['cook', 'admin']: return jsonify({'status': 'error'}), 403
+    days = min(flask_request.args.get('days', app.config['FORECAST_DAYS'], type=int), 366)
+    conn = get_db_connection()
+    if flask_request.method == 'GET':
+        rows = forecast_ingredients(conn, days)
+        conn.close()
+        return jsonify(rows)
+    drafts = run_immediate(conn, draft_purchase_requests, session['user_id'], days)
+    conn.close()
+    return jsonify({'status': 'success', 'created': len(drafts)})
+
+
 @app.route('/api/inventory/create_item', methods=['POST'])
 def create_item():
     if session.get('role') != 'cook': return jsonify({'status': 'error'}), 403
@@ -493,21 +1860,17 @@ def create_item():
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
     conn.close()
+    invalidate_dish_index()
     return jsonify({'status': 'success'})
 
 
 @app.route('/api/stats/cook', methods=['GET'])
 def get_cook_stats():
     conn = get_db_connection()
-
-    def cnt(mt, i): return conn.execute(
-        f"SELECT COUNT(o.id) as c FROM orders o JOIN menu m ON o.menu_id=m.id WHERE o.{'collected=1' if i else 'paid=1'} AND date(o.order_date)=date('now','localtime') AND m.meal_type=?",
-        (mt,)).fetchone()['c']
-
-    stats = {'breakfast': {'issued': cnt('breakfast', 1), 'sold': cnt('breakfast', 0)},
-             'lunch': {'issued': cnt('lunch', 1), 'sold': cnt('lunch', 0)}}
-    top = conn.execute(
-        "SELECT d.name, COUNT(o.id) as count FROM orders o JOIN menu m ON o.menu_id=m.id JOIN dishes d ON m.dish_id=d.id WHERE date(o.order_date)=date('now','localtime') GROUP BY d.name ORDER BY count DESC").fetchall()
+    stats = {'breakfast': {'issued': 0, 'sold': 0}, 'lunch': {'issued': 0, 'sold': 0}}
+    for r in conn.execute(STATS_TODAY_BY_MEAL):
+        if r['meal_type'] in stats: stats[r['meal_type']] = {'issued': r['issued'], 'sold': r['sold']}
+    top = conn.execute(STATS_TODAY_BY_DISH).fetchall()
     conn.close();
     return jsonify({'breakfast': stats['breakfast'], 'lunch': stats['lunch'],
                     'breakdown': [{'name': r['name'], 'count': r['count']} for r in top]})
@@ -515,28 +1878,39 @@ def get_cook_stats():
 @app.route('/api/admin/stats', methods=['GET'])
 def get_admin_stats():
     conn = get_db_connection();
-    att = conn.execute("SELECT COUNT(*) as c FROM orders WHERE date(order_date)=date('now','localtime')").fetchone()[
-        'c'];
-    rev = conn.execute(
-        "SELECT SUM(amount) as s FROM payments WHERE status='completed' AND date(payment_date)=date('now','localtime')").fetchone()[
-              's'] or 0;
-    tot = conn.execute("SELECT COUNT(*) as c FROM orders WHERE collected=1").fetchone()['c']
+    att = conn.execute(STATS_TODAY_ORDERS).fetchone()['c'];
+    rev = conn.execute(STATS_TODAY_REVENUE).fetchone();
+    rev = rev['s'] if rev else 0
+    tot = conn.execute("SELECT value as c FROM stats_totals WHERE name='issued'").fetchone()
     conn.close();
-    return jsonify({'attendance_today': att, 'revenue_today': rev, 'total_issued': tot})
+    return jsonify({'attendance_today': att, 'revenue_today': rev, 'total_issued': tot['c'] if tot else 0})
 
 
 @app.route('/api/purchase_requests/<int:rid>', methods=['PUT'])
 def update_req(rid):
     st = flask_request.get_json().get('status');
     conn = get_db_connection()
-    conn.execute(
-        'UPDATE purchase_requests SET status=?, approved_by=?, approved_date=datetime("now","localtime") WHERE id=?',
-        (st, session['user_id'], rid))
-    if st == 'approved':
+    if st == 'pending':
+        cur = conn.execute("UPDATE purchase_requests SET status='pending', request_date=CURRENT_TIMESTAMP WHERE id=? AND status='draft'",
+                           (rid,))
+    else:
+        cur = conn.execute(
+            'UPDATE purchase_requests SET status=?, approved_by=?, approved_date=datetime("now","localtime") WHERE id=? AND status=\'pending\'',
+            (st, session['user_id'], rid))
+    changed = cur.rowcount
+    if changed and st == 'approved':
         r = conn.execute('SELECT ingredient_id, quantity FROM purchase_requests WHERE id=?', (rid,)).fetchone()
         if r: conn.execute('UPDATE ingredients SET current_quantity=current_quantity+? WHERE id=?',
                            (r['quantity'], r['ingredient_id']))
     conn.commit();
+    # the cook is only told about decisions; submitting a draft just changes the admin's pending count
+    if changed and st in ('approved', 'rejected'):
+        n = conn.execute(
+            'SELECT i.name, pr.quantity, i.unit, pr.status, pr.requested_by FROM purchase_requests pr JOIN ingredients i ON pr.ingredient_id=i.id WHERE pr.id=?',
+            (rid,)).fetchone()
+        if n: publish_event('purchase_request', {'id': rid, 'name': n['name'], 'quantity': n['quantity'], 'unit': n['unit'],
+                                                 'status': n['status']}, role='cook', user_id=n['requested_by'])
+    if changed: publish_pending_count(conn)
     conn.close();
     return jsonify({'status': 'success'})
 
@@ -544,30 +1918,113 @@ def update_req(rid):
 @app.route('/api/admin/reports', methods=['GET'])
 def get_reports():
     conn = get_db_connection();
-    reps = conn.execute(
-        "SELECT date(payment_date) as date, SUM(amount) as revenue, COUNT(*) as transactions FROM payments WHERE status='completed' GROUP BY date(payment_date) ORDER BY date DESC LIMIT 7").fetchall();
+    reps = conn.execute(STATS_REVENUE_WEEK).fetchall();
     conn.close()
-    return jsonify([dict(r) for r in reps])
+    return jsonify(reps)
 
 
 @app.route('/api/admin/users', methods=['GET'])
 def get_users():
+    after, limit = page_args(100)
     conn = get_db_connection();
     users = conn.execute(
-        'SELECT u.id, u.username, u.email, u.role, u.subscription_end_date, u.created_at, (SELECT COUNT(*) FROM orders WHERE user_id=u.id) as total_orders FROM users u').fetchall();
+        'SELECT u.id, u.username, u.email, u.role, u.subscription_end_date, u.created_at, u.orders_count as total_orders FROM users u WHERE u.id > ? ORDER BY u.id LIMIT ?',
+        [after or 0, limit]).fetchall();
     conn.close()
-    return jsonify([dict(r) for r in users])
+    return paged(users, limit, lambda u: str(u['id']))
+
+
+def stream_export(name, sql, params, columns, span=None):
+    # sql ends with "<id> > ? AND <id> <= ? ORDER BY <id> LIMIT ?": rows are read in keyset-paginated chunks
+    # on a dedicated connection, so memory stays flat however large the range is; span (same params) gives the
+    # lowest and highest matching id, so the chunks only walk that stretch of the table
+    fmt = flask_request.args.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson'): return jsonify({'status': 'error', 'message': 'Неверный формат'}), 400
+    after = flask_request.args.get('after', 0, type=int)
+    limit = flask_request.args.get('limit', type=int)
+    chunk = app.config['EXPORT_CHUNK_SIZE']
+    tenant = current_tenant()
+
+    def generate():
+        conn = open_db_connection(tenant=tenant)
+        last, left, high = after, limit, 2 ** 63 - 1
+        try:
+            if fmt == 'csv': yield ','.join(columns) + '\r\n'
+            if span:
+                low, high = conn.execute(span, params).fetchone()
+                if low is None: return
+                last = max(last, low - 1)
+            while left is None or left > 0:
+                size = chunk if left is None else min(chunk, left)
+                rows = conn.execute(sql, (*params, last, high, size)).fetchall()
+                if not rows: break
+                buf = io.StringIO()
+                if fmt == 'csv':
+                    csv.writer(buf).writerows(tuple(r) for r in rows)
+                else:
+                    for r in rows: buf.write(json.dumps(dict(zip(columns, r)), ensure_ascii=False) + '\n')
+                yield buf.getvalue()
+                last = rows[-1][0]
+                if left is not None: left -= len(rows)
+                if len(rows) < size: break
+        finally:
+            conn.close()
+
+    return Response(generate(), mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson',
+                    headers={'Content-Disposition': f'attachment; filename={name}.{fmt}'})
+
+
+def export_range():
+    return (flask_request.args.get('from', '0000-00-00'), flask_request.args.get('to', '9999-12-31'))
+
+
+@app.route('/api/admin/export/payments', methods=['GET'])
+def export_payments():
+    if session.get('role') != 'admin': return jsonify({'status': 'error'}), 403
+    conn = get_db_connection()
+    payments = history(conn, 'payments')
+    return stream_export('payments', EXPORT_PAYMENTS.format(payments=payments), export_range(),
+                         ['id', 'payment_date', 'user_id', 'username', 'type', 'amount', 'order_id', 'status'],
+                         EXPORT_PAYMENTS_SPAN.format(payments=payments))
+
+
+@app.route('/api/admin/export/orders', methods=['GET'])
+def export_orders():
+    if session.get('role') != 'admin': return jsonify({'status': 'error'}), 403
+    conn = get_db_connection()
+    orders = history(conn, 'orders')
+    return stream_export('orders', EXPORT_ORDERS.format(orders=orders), export_range(),
+                         ['id', 'order_date', 'user_id', 'username', 'menu_date', 'meal_type', 'dish_name', 'price', 'paid', 'collected'],
+                         EXPORT_ORDERS_SPAN.format(orders=orders))
+
+
+@app.route('/api/admin/export/users', methods=['GET'])
+def export_user_totals():
+    if session.get('role') != 'admin': return jsonify({'status': 'error'}), 403
+    conn = get_db_connection()
+    return stream_export('users', EXPORT_USER_TOTALS.format(orders=history(conn, 'orders'), payments=history(conn, 'payments')),
+                         export_range(), ['id', 'username', 'email', 'role', 'balance', 'orders', 'paid_total'])
 
 
 @app.route('/api/admin/users/<int:uid>', methods=['PUT'])
 def update_role(uid):
     conn = get_db_connection();
-    conn.execute('UPDATE users SET role=? WHERE id=?', (flask_request.get_json().get('role'), uid));
+    role = flask_request.get_json().get('role')
+    conn.execute('UPDATE users SET role=? WHERE id=?', (role, uid));
     conn.commit();
     conn.close()
+    invalidate_principal(uid)
+    current_tenant().students.set_role(uid, role)
     return jsonify({'status': 'success'})
 
 
+@app.route('/api/admin/cache-stats', methods=['GET'])
+def get_cache_stats():
+    if session.get('role') != 'admin': return jsonify({'status': 'error'}), 403
+    tenant = current_tenant()
+    return jsonify({'principals': tenant.principals.stats(), 'students': len(tenant.students)})
+
+
 @app.route('/api/admin/active-subscriptions', methods=['GET'])
 def get_active_subs():
     conn = get_db_connection();
@@ -578,12 +2035,17 @@ def get_active_subs():
 
 @app.route('/api/admin/popular-dishes', methods=['GET'])
 def get_pop():
+    # top 5 from the cached rankings; ?period=today|7d|30d
+    period = flask_request.args.get('period', 'today')
     conn = get_db_connection();
-    top = conn.execute(
-        "SELECT d.name, COUNT(o.id) as count FROM orders o JOIN menu m ON o.menu_id=m.id JOIN dishes d ON m.dish_id=d.id WHERE date(o.order_date)=date('now', 'localtime') GROUP BY d.name ORDER BY count DESC LIMIT 5").fetchall();
+    top = sorted((r['popularity'][period]['rank'], dish_id, r['popularity'][period]['orders'])
+                 for dish_id, r in dish_rankings(conn).items() if period in r['popularity'])[:5]
+    names = dict(conn.execute(f"SELECT id, name FROM dishes WHERE id IN ({','.join('?' * len(top))})",
+                              [t[1] for t in top]).fetchall()) if top else {}
     conn.close()
-    return jsonify([{'name': r['name'], 'count': r['count'],
-                     'percentage': int((r['count'] / (sum([x['count'] for x in top]) or 1)) * 100)} for r in top])
+    total = sum(t[2] for t in top) or 1
+    return jsonify([{'name': names.get(dish_id), 'count': count, 'percentage': int(count / total * 100)}
+                    for _, dish_id, count in top])
 
 
 @app.route('/api/notifications/admin', methods=['GET'])
@@ -592,7 +2054,7 @@ def admin_notif():
 
     conn = get_db_connection()
     try:
-        count = conn.execute("SELECT COUNT(*) as c FROM purchase_requests WHERE status='pending'").fetchone()['c']
+        count = conn.execute(PENDING_REQUESTS).fetchone()['c']
     except:
         count = 0
     conn.close()
@@ -614,8 +2076,180 @@ def cook_notif():
     ''', (session['user_id'],)).fetchall()
 
     conn.close()
-    return jsonify([dict(n) for n in notifs]), 200
+    return jsonify(notifs), 200
+
+@app.route('/api/events', methods=['GET'])
+def events():
+    if 'user_id' not in session: return jsonify({'status': 'error'}), 401
+    last_id = flask_request.headers.get('Last-Event-ID', flask_request.args.get('last_id', ''))
+    last_id = int(last_id) if last_id.isdigit() else None
+    heartbeat = app.config['EVENTS_HEARTBEAT']
+    initial = None
+    if session['role'] == 'admin':
+        conn = get_db_connection()
+        c = conn.execute(PENDING_REQUESTS).fetchone()['c']
+        conn.close()
+        initial = {'name': 'pending', 'data': {'pending_count': c}}
+    if not take_event_stream():
+        # all stream slots are taken: answer with what was missed and let EventSource reconnect after
+        # EVENTS_POLL_RETRY ms with Last-Event-ID, so this thread goes back to serving normal requests
+        missed, newest = poll_events(session['role'], session['user_id'], last_id)
+        body = f"retry: {app.config['EVENTS_POLL_RETRY']}\n\n" + (format_sse(initial) if initial else '')
+        body += ''.join(format_sse(ev) for ev in missed) + ('' if missed else f'id: {max(newest, last_id or 0)}\n\n')
+        return Response(body, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    sub = subscribe_events(session['role'], session['user_id'], last_id or 0)
+
+    def stream():
+        try:
+            yield 'retry: 3000\n\n'
+            if initial: yield format_sse(initial)
+            while not shutting_down.is_set():
+                try:
+                    yield format_sse(sub[3].get(timeout=heartbeat))
+                except queue.Empty:
+                    yield ': ping\n\n'
+        finally:
+            unsubscribe_events(sub)
+
+    resp = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    resp.call_on_close(release_event_stream)
+    return resp
+
+
+# only one cProfile can be active per process (3.12+ refuses a second one), so concurrent profiled requests get 409
+_profile_lock = threading.Lock()
+
+
+def stop_profiler():
+    profiler = g.pop('profiler', None)
+    if profiler:
+        profiler.disable()
+        _profile_lock.release()
+    return profiler
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    if flask_request.headers.get(app.config['PROFILE_HEADER']) and session.get('role') == 'admin':
+        if not _profile_lock.acquire(blocking=False):
+            return jsonify({'status': 'error', 'message': 'Профилирование уже идёт'}), 409
+        g.profiler = cProfile.Profile()
+        try:
+            g.profiler.enable()
+        except ValueError:
+            g.pop('profiler')
+            _profile_lock.release()
+            return jsonify({'status': 'error', 'message': 'Профилирование уже идёт'}), 409
+
+
+@app.after_request
+def record_request_metrics(resp):
+    profiler = stop_profiler()
+    if profiler:
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(40)
+        resp = app.response_class(out.getvalue(), mimetype='text/plain')
+    if 'request_start' not in g: return resp
+    seconds = time.perf_counter() - g.request_start
+    sql_count, sql_seconds = g.get('sql_count', 0), g.get('sql_seconds', 0.0)
+    endpoint = flask_request.url_rule.rule if flask_request.url_rule else 'unmatched'
+    observe_request(endpoint, flask_request.method, resp.status_code, seconds, sql_count, sql_seconds)
+    resp.headers['Server-Timing'] = f'app;dur={seconds * 1000:.1f}, db;dur={sql_seconds * 1000:.1f};desc="{sql_count} queries"'
+    return resp
+
+
+@app.teardown_request
+def release_profiler(exc):
+    # after_request is skipped when the view raised
+    stop_profiler()
+
+
+_compressed = OrderedDict()
+_compressed_lock = threading.Lock()
+
+
+def compress_body(data, encoding):
+    if encoding == 'br': return brotli.compress(data, quality=app.config['COMPRESS_LEVEL'])
+    return gzip.compress(data, app.config['COMPRESS_LEVEL'], mtime=0)
+
+
+@app.after_request
+def compress_response(resp):
+    # API bodies above COMPRESS_MIN_SIZE go out as br or gzip, whichever the client accepts; bodies with an ETag
+    # (the cached menu) are compressed once per encoding
+    if (resp.direct_passthrough or resp.is_streamed or resp.status_code != 200 or 'Content-Encoding' in resp.headers
+            or resp.mimetype != 'application/json'): return resp
+    resp.vary.add('Accept-Encoding')
+    encoding = 'br' if brotli and flask_request.accept_encodings['br'] else 'gzip' if flask_request.accept_encodings['gzip'] else None
+    data = resp.get_data()
+    if not encoding or len(data) < app.config['COMPRESS_MIN_SIZE']: return resp
+    etag, weak = resp.get_etag()
+    key = (etag, encoding)
+    with _compressed_lock:
+        body = _compressed.get(key) if etag else None
+        if body is not None: _compressed.move_to_end(key)
+    if body is None:
+        body = compress_body(data, encoding)
+        if etag:
+            with _compressed_lock:
+                _compressed[key] = body
+                while len(_compressed) > app.config['COMPRESS_CACHE_SIZE']: _compressed.popitem(last=False)
+    resp.set_data(body)
+    resp.headers['Content-Encoding'] = encoding
+    # the same validator now names two different byte sequences, which only a weak ETag may do
+    if etag and not weak: resp.set_etag(etag, weak=True)
+    return resp
+
+
+@app.route('/metrics')
+def metrics():
+    lines = ['# TYPE http_request_duration_seconds histogram']
+    with _metrics_lock:
+        for (endpoint, method), (buckets, count, total, statuses) in sorted(_route_latency.items()):
+            labels = f'endpoint="{endpoint}",method="{method}"'
+            for le, n in zip(LATENCY_BUCKETS, buckets):
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{le}"}} {n}')
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'http_request_duration_seconds_sum{{{labels}}} {total:.6f}')
+            lines.append(f'http_request_duration_seconds_count{{{labels}}} {count}')
+        lines.append('# TYPE http_responses_total counter')
+        for (endpoint, method), h in sorted(_route_latency.items()):
+            for status, n in sorted(h[3].items()):
+                lines.append(f'http_responses_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {n}')
+        lines.append('# TYPE sql_statements_total counter')
+        lines += [f'sql_statements_total{{endpoint="{e}"}} {q[0]}' for e, q in sorted(_route_sql.items())]
+        lines.append('# TYPE sql_seconds_total counter')
+        lines += [f'sql_seconds_total{{endpoint="{e}"}} {q[1]:.6f}' for e, q in sorted(_route_sql.items())]
+        lines.append('# TYPE sql_slow_queries_total counter')
+        lines.append(f'sql_slow_queries_total {_slow_queries[0]}')
+        lines.append('# TYPE sql_lock_waits_total counter')
+        lines.append(f'sql_lock_waits_total {_lock_waits[0]}')
+    # summed over the schools currently open in this process
+    open_tenants = all_tenants()
+    stats = [t.principals.stats() for t in open_tenants]
+    lines += ['# TYPE principal_cache_hits_total counter', f"principal_cache_hits_total {sum(s['hits'] for s in stats)}",
+              '# TYPE principal_cache_misses_total counter', f"principal_cache_misses_total {sum(s['misses'] for s in stats)}",
+              '# TYPE db_pool_idle_connections gauge', f'db_pool_idle_connections {sum(len(t.pool) for t in open_tenants)}',
+              '# TYPE event_subscribers gauge', f'event_subscribers {len(_event_subscribers)}',
+              '# TYPE event_streams gauge', f'event_streams {_event_streams}',
+              '# TYPE login_throttled_total counter', f'login_throttled_total {login_buckets.throttled}',
+              '# TYPE write_queue_batches_total counter', f'write_queue_batches_total {sum(t.write_queue.batches for t in open_tenants)}',
+              '# TYPE write_queue_ops_total counter', f'write_queue_ops_total {sum(t.write_queue.ops for t in open_tenants)}',
+              '# TYPE tenants_open gauge', f'tenants_open {len(open_tenants)}',
+              '# TYPE tenants_evicted_total counter', f'tenants_evicted_total {tenants.evicted}']
+    return app.response_class('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+
+def create_app(config=None):
+    if config: app.config.update(config)
+    # with TENANTS_DIR set, each school is migrated and warmed when it is first requested (TenantPool.get)
+    if not app.config['TENANTS_DIR']: default_tenant.open()
+    precompress_static()
+    return app
+
 
 if __name__ == '__main__':
-    app.run(debug=True, host="0.0.0.0")
+    create_app().run(debug=os.environ.get('FLASK_DEBUG') == '1', host="0.0.0.0")
 
@@ -20,36 +20,34 @@ document.addEventListener('DOMContentLoaded', () => {
         }, 5000);
     }
 
-    let processedNotifications = new Set();
+    const events = new EventSource('/api/events');
 
-    setInterval(async () => {
-        try {
-            const res = await fetch('/api/notifications/cook');
-            const data = await res.json();
-
-            if (data.length > 0) {
-
-                const n = data[0];
-
-                const key = `${n.name}-${n.status}`;
-                if (processedNotifications.has(key)) return;
+    events.addEventListener('purchase_request', (e) => {
+        const n = JSON.parse(e.data);
 
-                processedNotifications.add(key);
-                setTimeout(() => processedNotifications.delete(key), 20000);
+        if (n.status === 'approved') {
+            showCookNotification('Заявка одобрена!', `${n.name}: ${n.quantity} ${n.unit}`, 'approved');
+            loadInventoryData();
+        } else if (n.status === 'rejected') {
+            showCookNotification('Заявка отклонена', `${n.name}: ${n.quantity} ${n.unit}`, 'rejected');
+        } else {
+            return;
+        }
 
-                if (n.status === 'approved') {
-                    showCookNotification('Заявка одобрена!', `${n.name}: ${n.quantity} ${n.unit}`, 'approved');
-                    loadInventoryData();
-                } else {
-                    showCookNotification('Заявка отклонена', `${n.name}: ${n.quantity} ${n.unit}`, 'rejected');
-                }
+        if (document.getElementById('procurement').classList.contains('active')) {
+            loadProcurementData();
+        }
+    });
 
-                if (document.getElementById('procurement').classList.contains('active')) {
-                    loadProcurementData();
-                }
-            }
-        } catch(e) {}
-    }, 5000);
+    // during the lunch rush orders arrive several per second; reload the stock table at most once per burst
+    let inventoryReload = null;
+    events.addEventListener('order', () => {
+        if (inventoryReload) return;
+        inventoryReload = setTimeout(() => {
+            inventoryReload = null;
+            if (document.getElementById('inventory').classList.contains('active')) loadInventoryData();
+        }, 2000);
+    });
     const tabs = document.querySelectorAll('.tab-btn');
     const contents = document.querySelectorAll('.tab-content');
 
@@ -87,7 +85,7 @@ document.addEventListener('DOMContentLoaded', () => {
         btnSearch.addEventListener('click', async () => {
             const ident = inputSearch.value.trim();
             if (!ident) {
-                resultDiv.innerHTML = '<p style="color:red; text-align:center;">Введите ID или имя!</p>';
+                resultDiv.innerHTML = '<p style="color:red; text-align:center;">Введите ID, имя или код!</p>';
                 return;
             }
             resultDiv.innerHTML = '<p style="text-align:center;">Поиск...</p>';
@@ -167,18 +165,17 @@ document.addEventListener('DOMContentLoaded', () => {
         const container = document.getElementById('menuListContainer');
         container.innerHTML = '<p>Загрузка...</p>';
         try {
-            const res = await fetch(`/api/menu/full?date=${date}`);
-            const menu = await res.json();
-            if (!menu.length) {
+            const res = await fetch(`/api/menu/range?from=${date}&to=${date}`);
+            const days = await res.json();
+            const day = days[date];
+            if (!day) {
                 container.innerHTML = '<p style="color:#777; text-align:center;">Меню пустое</p>';
                 return;
             }
 
-            const bf = menu.filter(i => i.meal_type === 'breakfast');
-            const ln = menu.filter(i => i.meal_type === 'lunch');
             let html = '';
-            if (bf.length) html += '<h4 style="color:#1976D2; margin:15px 0 5px;">Завтрак</h4>' + renderMenuTable(bf);
-            if (ln.length) html += '<h4 style="color:#388E3C; margin:15px 0 5px;">Обед</h4>' + renderMenuTable(ln);
+            if (day.breakfast.length) html += '<h4 style="color:#1976D2; margin:15px 0 5px;">Завтрак</h4>' + renderMenuTable(day.breakfast);
+            if (day.lunch.length) html += '<h4 style="color:#388E3C; margin:15px 0 5px;">Обед</h4>' + renderMenuTable(day.lunch);
             container.innerHTML = html;
         } catch (e) {
             container.innerHTML = 'Ошибка загрузки меню';
@@ -188,12 +185,13 @@ document.addEventListener('DOMContentLoaded', () => {
     function renderMenuTable(items) {
         return `<table class="accounting-table" style="margin-bottom:10px;">
             <thead>
-                <tr><th>Блюдо</th><th>Действие</th></tr>
+                <tr><th>Блюдо</th><th>Заказано</th><th>Действие</th></tr>
             </thead>
             <tbody>
                 ${items.map(i => `
                     <tr>
                         <td>${i.dish_name}</td>
+                        <td>${i.ordered} / ${i.max_portions ?? '∞'}</td>
                         <td>
                             <button style="background:#c62828; padding:4px 8px; font-size:12px; margin:0;"
                                     onclick="deleteMenuItem(${i.id})">Удалить</button>
@@ -204,26 +202,47 @@ document.addEventListener('DOMContentLoaded', () => {
         </table>`;
     }
 
+    async function menuBatch(ops) {
+        const res = await fetch('/api/menu/batch', {
+            method:'POST',
+            headers:{'Content-Type':'application/json'},
+            body:JSON.stringify(ops)
+        });
+        const data = await res.json();
+        const failed = (data.results || []).filter(r => r.status !== 'success');
+        if (!res.ok || failed.length) alert(data.message || failed.map(r => r.message).join('\n'));
+        return data;
+    }
+
     window.addMenuItem = async function() {
         const date = document.getElementById('menuDate').value;
         const type = document.getElementById('menuMealType').value;
         const id = document.getElementById('menuDishSelect').value;
         if (!id) return alert('Выберите блюдо');
-        await fetch('/api/menu/add', {
-            method:'POST',
-            headers:{'Content-Type':'application/json'},
-            body:JSON.stringify({date, meal_type:type, dish_id:id})
-        });
+        await menuBatch({add: [{date, meal_type:type, dish_id:id}]});
         loadMenuEditor();
     };
 
     window.deleteMenuItem = async function(id) {
         if(confirm('Удалить?')) {
-            await fetch(`/api/menu/delete/${id}`, { method:'DELETE'});
+            await menuBatch({delete: [id]});
             loadMenuEditor();
         }
     };
 
+    window.copyMenuWeek = async function() {
+        const picked = document.getElementById('menuDate').value;
+        if (!picked) return alert('Выберите дату');
+        const monday = new Date(picked + 'T00:00:00Z');
+        monday.setUTCDate(monday.getUTCDate() - (monday.getUTCDay() + 6) % 7);
+        const next = new Date(monday);
+        next.setUTCDate(next.getUTCDate() + 7);
+        const iso = d => d.toISOString().slice(0, 10);
+        if (!confirm(`Скопировать неделю с ${iso(monday)} на неделю с ${iso(next)}?`)) return;
+        const data = await menuBatch({copy: {from: iso(monday), to: [iso(next)], days: 7}});
+        if (data.results) alert(`Добавлено позиций: ${data.results.reduce((n, r) => n + (r.result || 0), 0)}`);
+    };
+
     window.loadInventoryData = async function() {
         try {
             const resDishes = await fetch('/api/dishes');
@@ -394,6 +413,10 @@ document.addEventListener('DOMContentLoaded', () => {
                         statusClass = 'status-rejected';
                         statusText = 'Отклонено';
                     }
+                    if (r.status === 'draft') {
+                        statusClass = 'status-draft';
+                        statusText = `Черновик <button class="btn-small" onclick="submitDraft(${r.id})">Отправить</button>`;
+                    }
 
                     return `
                     <tr>
@@ -423,6 +446,24 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
+    if(document.getElementById('btnForecast')) {
+        document.getElementById('btnForecast').addEventListener('click', async () => {
+            const res = await fetch('/api/inventory/forecast', { method: 'POST' });
+            const data = await res.json();
+            alert(`Создано черновиков: ${data.created}`);
+            loadProcurementData();
+        });
+    }
+
+    window.submitDraft = async function(id) {
+        await fetch(`/api/purchase_requests/${id}`, {
+            method: 'PUT',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({status: 'pending'})
+        });
+        loadProcurementData();
+    };
+
     window.loadStats = async function() {
         const brIssued = document.getElementById('statIssuedBreakfast');
         const brSold = document.getElementById('statSoldBreakfast');
@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import threading
+import multiprocessing
+
+# Many students in several processes order the same dish at once (each twice). Checks that stock is never
+# oversold, nobody is charged twice or goes negative, and reports orders/second.
+#   python bench/concurrent_orders.py
+#   python bench/concurrent_orders.py --students 500 --processes 8 --stock 300
+# exits 1 when an invariant is broken
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(root, 'database'))
+import init_db
+
+
+def seed(db, students, stock, balance):
+    init_db.create_tables(db)
+    init_db.seed_data(db)
+    init_db.migrate(db)
+    conn = sqlite3.connect(db)
+    conn.executemany("INSERT INTO users (username, email, password_hash, role, balance) VALUES (?, ?, 'x', 'student', ?)",
+                     [(f'load{i}', f'load{i}@school.ru', balance) for i in range(students)])
+    for sql in init_db.OPEN_LEDGER: conn.execute(sql)
+    menu_id, dish_id = conn.execute("SELECT m.id, m.dish_id FROM menu m JOIN dishes d ON d.id = m.dish_id ORDER BY m.id LIMIT 1").fetchone()
+    conn.execute('UPDATE dishes SET current_stock=? WHERE id=?', (stock, dish_id))
+    conn.commit()
+    uids = [r[0] for r in conn.execute("SELECT id FROM users WHERE username LIKE 'load%'")]
+    conn.close()
+    return uids, menu_id, dish_id
+
+
+def worker(db, uids, menu_id, results):
+    os.environ['DB_PATH'] = db
+    sys.path.insert(0, os.path.join(root, 'Backend'))
+    import app as appmod
+    flask_app = appmod.create_app({'TESTING': True})
+    counts = {}
+    lock = threading.Lock()
+
+    def student(uid):
+        client = flask_app.test_client()
+        with client.session_transaction() as s:
+            s['user_id'], s['role'] = uid, 'student'
+        for _ in range(2):
+            status = client.post('/api/orders', json={'menu_id': menu_id}).status_code
+            with lock: counts[status] = counts.get(status, 0) + 1
+
+    threads = [threading.Thread(target=student, args=(uid,)) for uid in uids]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    results.put(counts)
+
+
+def main():
+    p = argparse.ArgumentParser(description='Concurrent order correctness and throughput')
+    p.add_argument('--students', type=int, default=500)
+    p.add_argument('--processes', type=int, default=8)
+    p.add_argument('--stock', type=int, default=300)
+    p.add_argument('--balance', type=float, default=100)
+    args = p.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    db = os.path.join(tmp, 'orders.db')
+    try:
+        uids, menu_id, dish_id = seed(db, args.students, args.stock, args.balance)
+        ctx = multiprocessing.get_context('spawn')
+        results = ctx.Queue()
+        procs = [ctx.Process(target=worker, args=(db, uids[i::args.processes], menu_id, results))
+                 for i in range(args.processes)]
+        start = time.perf_counter()
+        for proc in procs: proc.start()
+        counts = {}
+        for _ in procs:
+            for status, n in results.get().items(): counts[status] = counts.get(status, 0) + n
+        for proc in procs: proc.join()
+        wall = time.perf_counter() - start
+
+        conn = sqlite3.connect(db)
+        stock = conn.execute('SELECT current_stock FROM dishes WHERE id=?', (dish_id,)).fetchone()[0]
+        orders = conn.execute('SELECT COUNT(*) FROM orders WHERE menu_id=?', (menu_id,)).fetchone()[0]
+        dup = conn.execute('SELECT COUNT(*) FROM (SELECT 1 FROM orders GROUP BY user_id, menu_id HAVING COUNT(*) > 1)').fetchone()[0]
+        negative = conn.execute('SELECT COUNT(*) FROM users u WHERE u.balance_cents + COALESCE((SELECT SUM(amount_cents) FROM ledger '
+                                'WHERE user_id = u.id AND seq > u.ledger_seq), 0) < 0').fetchone()[0]
+        conn.close()
+        problems = init_db.reconcile(db)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f'{args.students} students x2 in {args.processes} processes: {wall:.2f}s, {counts.get(200, 0) / wall:.1f} orders/s')
+    print('responses:', ', '.join(f'{s}: {n}' for s, n in sorted(counts.items())))
+    print(f'orders {orders}, stock left {stock} (of {args.stock}), duplicate orders {dup}, negative balances {negative}')
+    failed = [msg for bad, msg in (
+        (orders + stock != args.stock, 'stock does not add up'),
+        (orders != counts.get(200, 0), 'orders differ from successful responses'),
+        (stock < 0, 'stock went negative'), (dup, 'duplicate orders'), (negative, 'negative balances'),
+        (counts.get(500, 0), 'server errors')) if bad] + problems
+    for msg in failed: print('FAIL', msg)
+    if failed: sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+
+# Runs bench/school_day.py once per connection profile and compares them: a fresh rollback-journal connection per
+# request (the old get_db_connection()), the same with WAL, and the pooled, tuned defaults.
+#   python bench/db_settings.py
+#   python bench/db_settings.py --server --students 300 --concurrency 32   # extra arguments go to school_day.py
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+PROFILES = {
+    'per-request': {'DB_POOL_SIZE': '0', 'DB_JOURNAL_MODE': 'DELETE', 'DB_SYNCHRONOUS': 'FULL', 'DB_CACHE_SIZE': '-2000',
+                    'DB_MMAP_SIZE': '0', 'DB_CACHED_STATEMENTS': '128'},
+    'per-request+wal': {'DB_POOL_SIZE': '0', 'DB_JOURNAL_MODE': 'WAL', 'DB_SYNCHRONOUS': 'NORMAL', 'DB_CACHE_SIZE': '-2000',
+                        'DB_MMAP_SIZE': '0', 'DB_CACHED_STATEMENTS': '128'},
+    'pooled': {},
+}
+
+
+def main():
+    p = argparse.ArgumentParser(description='Connection settings comparison', epilog='other arguments are passed to school_day.py')
+    p.add_argument('--profiles', default=','.join(PROFILES))
+    args, rest = p.parse_known_args()
+
+    rows = []
+    for name in args.profiles.split(','):
+        env = dict(os.environ, **PROFILES[name])
+        with tempfile.NamedTemporaryFile(suffix='.json') as out:
+            subprocess.run([sys.executable, os.path.join(here, 'school_day.py'), '--json', out.name] + rest,
+                           env=env, check=True, stdout=subprocess.DEVNULL)
+            result = json.load(open(out.name))
+        orders = result.get('POST /api/orders', {})
+        rows.append((name, sum(r['count'] for r in result.values()), sum(r['errors'] for r in result.values()),
+                     sum(r['rps'] for r in result.values()), orders.get('p50_ms', 0), orders.get('p95_ms', 0)))
+
+    print(f"{'profile':18} {'requests':>9} {'errors':>7} {'rps':>8} {'orders p50':>11} {'orders p95':>11}")
+    for name, count, errors, rps, p50, p95 in rows:
+        print(f'{name:18} {count:9} {errors:7} {rps:8.1f} {p50:11.1f} {p95:11.1f}')
+
+
+if __name__ == '__main__':
+    main()
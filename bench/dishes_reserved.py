@@ -0,0 +1,95 @@
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+
+# /api/dishes "reserved" counts: the old per-dish COUNT against the grouped query get_dishes() runs now,
+# on the current schema and again with the secondary indexes dropped (the schema the per-dish loop was written for).
+#   python bench/dishes_reserved.py
+#   python bench/dishes_reserved.py --dishes 200 --orders 10000 --repeat 20
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(root, 'database'))
+import init_db
+
+PER_DISH = ("SELECT COUNT(o.id) as c FROM orders o JOIN menu m ON o.menu_id=m.id WHERE m.dish_id=? AND o.collected=0 "
+            "AND date(o.order_date)=date('now','localtime')")
+GROUPED = init_db.DISHES_RESERVED
+
+
+def seed(db, dishes, orders):
+    # a week of history from seed_load, then `orders` uncollected orders for today spread over every dish
+    init_db.create_tables(db)
+    init_db.seed_data(db)
+    students = max(1, -(-orders // (dishes * 2)))
+    init_db.seed_load(students, dishes, 1, db_path=db)
+    conn = sqlite3.connect(db)
+    today = conn.execute("SELECT date('now','localtime')").fetchone()[0]
+    conn.execute('DELETE FROM orders WHERE order_day=?', (today,))
+    conn.execute('DELETE FROM menu WHERE date=?', (today,))
+    conn.executemany('INSERT INTO menu (date, meal_type, dish_id) VALUES (?, ?, ?)',
+                     [(today, meal, d) for (d,) in conn.execute('SELECT id FROM dishes').fetchall() for meal in ('breakfast', 'lunch')])
+    menu_ids = [r[0] for r in conn.execute('SELECT id FROM menu WHERE date=?', (today,))]
+    student_ids = [r[0] for r in conn.execute("SELECT id FROM users WHERE role='student' ORDER BY id")]
+    rows = [(u, m, f'{today} 08:00:00') for u in student_ids for m in menu_ids][:orders]
+    conn.executemany('INSERT INTO orders (user_id, menu_id, order_date, paid, collected) VALUES (?, ?, ?, 1, 0)', rows)
+    conn.commit()
+    conn.close()
+    init_db.rebuild_stats(db)
+    return len(rows)
+
+
+def best_of(repeat, fn):
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best * 1000
+
+
+def main():
+    p = argparse.ArgumentParser(description='Reserved counts for /api/dishes')
+    p.add_argument('--dishes', type=int, default=200)
+    p.add_argument('--orders', type=int, default=10000)
+    p.add_argument('--repeat', type=int, default=10)
+    args = p.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    db = os.path.join(tmp, 'dishes.db')
+    try:
+        n = seed(db, args.dishes, args.orders)
+        os.environ.update(DB_PATH=db, HASH_WORKERS='0')
+        sys.path.insert(0, os.path.join(root, 'Backend'))
+        import app as appmod
+        client = appmod.create_app({'TESTING': True}).test_client()
+        client.post('/api/login', json={'username': 'Cook', 'password': '1234'})
+        client.get('/api/dishes')
+        endpoint_ms = best_of(args.repeat, lambda: client.get('/api/dishes'))
+        conn = sqlite3.connect(db)
+        ids = [r[0] for r in conn.execute('SELECT id FROM dishes')]
+        old = {i: conn.execute(PER_DISH, (i,)).fetchone()[0] for i in ids}
+        new = {r[0]: r[-1] for r in conn.execute(GROUPED)}
+        if old != new: raise SystemExit('grouped query disagrees with the per-dish counts')
+        timings = {}
+        for schema in ('indexed', 'no indexes'):
+            if schema == 'no indexes':
+                for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type='index' AND sql IS NOT NULL AND sql NOT LIKE 'CREATE UNIQUE%'").fetchall():
+                    conn.execute(f'DROP INDEX {name}')
+            timings[schema] = (best_of(args.repeat, lambda: [conn.execute(PER_DISH, (i,)).fetchone() for i in ids]),
+                               best_of(args.repeat, lambda: conn.execute(GROUPED).fetchall()))
+        conn.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f'{len(ids)} dishes, {n} orders today; GET /api/dishes {endpoint_ms:.1f} ms')
+    print(f"{'schema':12} {'per-dish ms':>12} {'grouped ms':>11}")
+    for schema, (per_dish_ms, grouped_ms) in timings.items():
+        print(f'{schema:12} {per_dish_ms:12.1f} {grouped_ms:11.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+# Serialization time and bytes on the wire for the listing endpoints.
+#   python bench/payloads.py
+#   python bench/payloads.py --students 2000 --weeks 8 --repeat 50
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(root, 'database'))
+import init_db
+
+ENDPOINTS = [
+    ('admin', '/api/admin/users?limit=500'),
+    ('admin', '/api/admin/users?limit=500&shape=columns'),
+    ('student', '/api/orders/my'),
+    ('student', '/api/orders/my?shape=columns'),
+    ('admin', '/api/dishes'),
+    ('student', '/api/menu/today'),
+]
+
+
+def best_of(repeat, fn):
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t)
+    return best * 1000
+
+
+def main():
+    p = argparse.ArgumentParser(description='JSON payload benchmark')
+    p.add_argument('--students', type=int, default=1000)
+    p.add_argument('--dishes', type=int, default=40)
+    p.add_argument('--weeks', type=int, default=8)
+    p.add_argument('--repeat', type=int, default=20)
+    args = p.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    db = os.path.join(tmp, 'bench.db')
+    try:
+        init_db.create_tables(db)
+        init_db.seed_data(db)
+        init_db.seed_load(args.students, args.dishes, args.weeks, db_path=db)
+        os.environ['DB_PATH'] = db
+        sys.path.insert(0, os.path.join(root, 'Backend'))
+        import app as appmod
+        flask_app = appmod.create_app({'TESTING': True})
+        clients = {}
+        for role, username in (('admin', 'Admin'), ('student', 'student1')):
+            clients[role] = flask_app.test_client()
+            clients[role].post('/api/login', json={'username': username, 'password': '1234'})
+
+        print(f"orjson: {'yes' if appmod.orjson else 'no'}, brotli: {'yes' if appmod.brotli else 'no'}")
+        print(f"{'endpoint':42} {'stdlib ms':>9} {'fast ms':>8} {'req ms':>7} {'flask B':>9} {'utf8 B':>9} {'gzip B':>8} {'br B':>8}")
+        with flask_app.app_context():
+            for role, url in ENDPOINTS:
+                client = clients[role]
+                data = client.get(url).get_data()
+                obj = json.loads(data)
+                # Flask's stock provider: ensure_ascii and sorted keys
+                stock = json.dumps(obj, ensure_ascii=True, sort_keys=True).encode()
+                stdlib_ms = best_of(args.repeat, lambda: json.dumps(obj, ensure_ascii=True, sort_keys=True))
+                fast_ms = best_of(args.repeat, lambda: flask_app.json.dumps(obj))
+                req_ms = best_of(args.repeat, lambda: client.get(url, headers={'Accept-Encoding': 'gzip'}))
+                gz = len(gzip.compress(data, flask_app.config['COMPRESS_LEVEL']))
+                br = len(appmod.compress_body(data, 'br')) if appmod.brotli else '-'
+                print(f'{url:42} {stdlib_ms:9.2f} {fast_ms:8.2f} {req_ms:7.2f} {len(stock):9} {len(data):9} {gz:8} {br:>8}')
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
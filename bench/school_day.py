@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.cookiejar
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+# Replays a school day against Backend/app.py and reports latency percentiles per endpoint.
+#   python bench/school_day.py                          # Flask test client, in-process
+#   python bench/school_day.py --server                 # spawns gunicorn on a seeded copy
+#   python bench/school_day.py --url http://host:5000   # already running server (seed it with init_db.py seed-load)
+#   python bench/school_day.py --write-queue            # same, with group commit (WRITE_QUEUE=1)
+#   python bench/school_day.py --save-baseline bench/baseline.json
+#   python bench/school_day.py --baseline bench/baseline.json --tolerance 0.25   # exit 1 on regression
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(root, 'database'))
+import init_db
+
+
+class TestClientSession:
+    def __init__(self, client):
+        self.client = client
+
+    def request(self, method, url, body=None):
+        r = self.client.open(url, method=method, json=body)
+        return r.status_code, r.get_data()
+
+
+class HttpSession:
+    def __init__(self, base):
+        self.base = base
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, method, url, body=None):
+        data = json.dumps(body).encode() if body is not None else None
+        req = urllib.request.Request(self.base + url, data=data, method=method,
+                                     headers={'Content-Type': 'application/json'} if data else {})
+        try:
+            with self.opener.open(req, timeout=60) as r: return r.status, r.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+class Recorder:
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def call(self, session, name, method, url, body=None, ok=(200, 304, 400)):
+        t = time.perf_counter()
+        status, data = session.request(method, url, body)
+        elapsed = time.perf_counter() - t
+        with self.lock:
+            self.samples.setdefault(name, []).append(elapsed)
+            if status not in ok: self.errors[name] = self.errors.get(name, 0) + 1
+        return status, data
+
+    def report(self, wall):
+        res = {}
+        for name, xs in sorted(self.samples.items()):
+            xs = sorted(xs)
+            pct = lambda p: xs[min(len(xs) - 1, int(round(p / 100 * (len(xs) - 1))))] * 1000
+            res[name] = {'count': len(xs), 'errors': self.errors.get(name, 0), 'p50_ms': round(pct(50), 2),
+                         'p95_ms': round(pct(95), 2), 'p99_ms': round(pct(99), 2),
+                         'rps': round(len(xs) / wall, 1)}
+        return res
+
+
+def seed(db, students, dishes, weeks):
+    init_db.create_tables(db)
+    init_db.seed_data(db)
+    init_db.seed_load(students, dishes, weeks, db_path=db)
+
+
+def run_phase(pool, fn, items):
+    list(pool.map(fn, items))
+
+
+def school_day(make_session, rec, students, concurrency, rnd):
+    sessions = {}
+
+    def login(uid):
+        s = make_session()
+        rec.call(s, 'POST /api/login', 'POST', '/api/login', {'username': f'student{uid}', 'password': '1234'})
+        sessions[uid] = s
+
+    def pre_order(uid):
+        s = sessions[uid]
+        status, data = rec.call(s, 'GET /api/menu/today', 'GET', '/api/menu/today')
+        menu = json.loads(data)
+        if rnd.random() < 0.4 and menu['breakfast']:
+            rec.call(s, 'POST /api/orders', 'POST', '/api/orders', {'menu_id': rnd.choice(menu['breakfast'])['id']})
+        rec.call(s, 'GET /api/user/profile', 'GET', '/api/user/profile')
+
+    def lunch_rush(uid):
+        s = sessions[uid]
+        status, data = rec.call(s, 'GET /api/menu/today', 'GET', '/api/menu/today')
+        menu = json.loads(data)
+        if rnd.random() < 0.7 and menu['lunch']:
+            rec.call(s, 'POST /api/orders', 'POST', '/api/orders', {'menu_id': rnd.choice(menu['lunch'])['id']})
+        rec.call(s, 'GET /api/orders/my', 'GET', '/api/orders/my')
+
+    cook = make_session()
+    rec.call(cook, 'POST /api/login', 'POST', '/api/login', {'username': 'Cook', 'password': '1234'})
+    admin = make_session()
+    rec.call(admin, 'POST /api/login', 'POST', '/api/login', {'username': 'Admin', 'password': '1234'})
+
+    def serve(uid):
+        status, data = rec.call(cook, 'POST /api/cook/check_orders', 'POST', '/api/cook/check_orders',
+                                {'student_identifier': f'student{uid}'})
+        for o in json.loads(data).get('orders', []):
+            rec.call(cook, 'POST /api/cook/finish_order', 'POST', '/api/cook/finish_order', {'order_id': o['id']})
+
+    def dashboards(_):
+        rec.call(cook, 'GET /api/dishes', 'GET', '/api/dishes')
+        rec.call(cook, 'GET /api/stats/cook', 'GET', '/api/stats/cook')
+        rec.call(admin, 'GET /api/admin/stats', 'GET', '/api/admin/stats')
+        rec.call(admin, 'GET /api/admin/reports', 'GET', '/api/admin/reports')
+        rec.call(admin, 'GET /api/admin/users', 'GET', '/api/admin/users')
+
+    def timed(name, fn, items):
+        start = time.perf_counter()
+        run_phase(pool, fn, items)
+        rec.phases[name] = (len(items), time.perf_counter() - start)
+
+    def login_storm():
+        # everyone logs in at once while a probe keeps reading the menu, to show what hashing costs other requests
+        stop = threading.Event()
+        probe = make_session()
+
+        def poll():
+            while not stop.wait(0.01): rec.call(probe, 'GET /api/menu/today @login', 'GET', '/api/menu/today')
+
+        t = threading.Thread(target=poll)
+        t.start()
+        timed('login', login, uids)
+        stop.set()
+        t.join()
+
+    uids = list(range(students))
+    with ThreadPoolExecutor(concurrency) as pool:
+        login_storm()
+        timed('pre_order', pre_order, uids)
+        timed('serve', serve, uids[:len(uids) // 2])
+        timed('lunch_rush', lunch_rush, uids)
+        timed('serve_lunch', serve, uids)
+        run_phase(pool, dashboards, range(max(1, students // 25)))
+
+
+def start_server(db, port):
+    env = dict(os.environ, DB_PATH=db, WEB_BIND=f'127.0.0.1:{port}')
+    proc = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py'], cwd=root, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/readyz', timeout=1)
+            return proc
+        except Exception:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError('server did not become ready')
+
+
+def check_regressions(result, baseline, tolerance):
+    failed = []
+    for name, base in baseline.items():
+        cur = result.get(name)
+        if not cur: continue
+        if cur['errors'] > base.get('errors', 0): failed.append(f"{name}: {cur['errors']} errors")
+        limit = base['p95_ms'] * (1 + tolerance) + 1
+        if cur['p95_ms'] > limit: failed.append(f"{name}: p95 {cur['p95_ms']}ms > {limit:.1f}ms")
+    return failed
+
+
+def main():
+    p = argparse.ArgumentParser(description='School day load test')
+    p.add_argument('--students', type=int, default=300)
+    p.add_argument('--dishes', type=int, default=40)
+    p.add_argument('--weeks', type=int, default=4)
+    p.add_argument('--concurrency', type=int, default=16)
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--url', help='benchmark an already running server instead of the test client')
+    p.add_argument('--server', action='store_true', help='start gunicorn on the seeded database')
+    p.add_argument('--port', type=int, default=5099)
+    p.add_argument('--write-queue', action='store_true', help='coalesce order and issue writes (WRITE_QUEUE=1)')
+    p.add_argument('--json', help='write the report to this file')
+    p.add_argument('--baseline', help='fail if p95 regresses against this report')
+    p.add_argument('--save-baseline', help='write the report as the new baseline')
+    p.add_argument('--tolerance', type=float, default=0.25)
+    args = p.parse_args()
+
+    if args.write_queue: os.environ['WRITE_QUEUE'] = '1'
+    tmp = tempfile.mkdtemp()
+    db = os.path.join(tmp, 'bench.db')
+    proc = None
+    try:
+        if not args.url: seed(db, args.students, args.dishes, args.weeks)
+        if args.url:
+            make_session = lambda: HttpSession(args.url.rstrip('/'))
+        elif args.server:
+            proc = start_server(db, args.port)
+            make_session = lambda: HttpSession(f'http://127.0.0.1:{args.port}')
+        else:
+            os.environ['DB_PATH'] = db
+            sys.path.insert(0, os.path.join(root, 'Backend'))
+            import app as appmod
+            flask_app = appmod.create_app({'TESTING': True})
+            make_session = lambda: TestClientSession(flask_app.test_client())
+
+        rec = Recorder()
+        t = time.perf_counter()
+        school_day(make_session, rec, args.students, args.concurrency, random.Random(args.seed))
+        result = rec.report(time.perf_counter() - t)
+        phases = rec.phases
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f"{'endpoint':34} {'count':>6} {'err':>4} {'p50ms':>8} {'p95ms':>8} {'p99ms':>8} {'rps':>8}")
+    for name, r in result.items():
+        print(f"{name:34} {r['count']:6} {r['errors']:4} {r['p50_ms']:8} {r['p95_ms']:8} {r['p99_ms']:8} {r['rps']:8}")
+    print(f"{'total':34} {sum(r['count'] for r in result.values()):6} {sum(r['errors'] for r in result.values()):4}"
+          f" {'':8} {'':8} {'':8} {sum(r['rps'] for r in result.values()):8.1f}")
+    for name, (n, secs) in phases.items():
+        print(f'{name} phase: {n} in {secs:.2f}s ({n / secs:.1f}/s)')
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, 'w') as f: json.dump(result, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f: failed = check_regressions(result, json.load(f), args.tolerance)
+        for line in failed: print('REGRESSION', line)
+        if failed: sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
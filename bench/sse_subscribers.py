@@ -0,0 +1,202 @@
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.cookiejar
+import urllib.error
+import urllib.request
+
+# Many /api/events clients (cooks, admins, students) against gunicorn started from gunicorn.conf.py, while orders
+# and purchase requests are posted one by one. Past EVENTS_MAX_STREAMS the server answers in polling mode, so the
+# clients here behave like EventSource: honour retry:, reconnect with Last-Event-ID. Checks every client got exactly
+# the events meant for its role, that /healthz stays fast with all clients connected, and reports delivery latency.
+#   python bench/sse_subscribers.py
+#   python bench/sse_subscribers.py --threads 4 --cooks 20 --admins 4 --students 20
+# exits 1 when an event is lost, reaches the wrong role, or /healthz is slow
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(root, 'database'))
+import init_db
+
+STREAM_RETRY = 3000  # what /api/events sends on a held stream; polling answers carry EVENTS_POLL_RETRY
+
+
+class Session:
+    def __init__(self, base, username):
+        self.base = base
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        status = self.post('/api/login', {'username': username, 'password': '1234'})
+        if status != 200: raise SystemExit(f'login {username}: {status}')
+
+    def post(self, path, data):
+        req = urllib.request.Request(self.base + path, json.dumps(data).encode(), {'Content-Type': 'application/json'})
+        try:
+            with self.opener.open(req) as resp: return resp.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+
+class Subscriber(threading.Thread):
+    # a minimal EventSource: keeps reconnecting until stopped and stamps every event that has an id with its arrival
+    def __init__(self, session, role, ready, stop):
+        super().__init__(daemon=True)
+        self.session, self.role, self.ready, self.stop = session, role, ready, stop
+        self.events, self.last_id, self.retry, self.polling, self.connects = [], None, STREAM_RETRY, False, 0
+
+    def run(self):
+        while not self.stop.is_set():
+            headers = {'Last-Event-ID': self.last_id} if self.last_id is not None else {}
+            req = urllib.request.Request(self.session.base + '/api/events', headers=headers)
+            try:
+                with self.session.opener.open(req) as stream: self.read(stream)
+            except OSError:
+                pass
+            self.stop.wait(self.retry / 1000)
+
+    def read(self, stream):
+        name = ev_id = None
+        for raw in stream:
+            line = raw.decode().rstrip('\n')
+            if line.startswith('retry: '):
+                self.retry = int(line[7:])
+                self.polling = self.retry != STREAM_RETRY
+                self.connects += 1
+                if self.connects == 1: self.ready.release()
+            elif line.startswith('id: '): ev_id = self.last_id = line[4:]
+            elif line.startswith('event: '): name = line[7:]
+            elif line.startswith('data: ') and ev_id is not None: self.events.append((name, int(ev_id), time.perf_counter()))
+            elif not line: name = ev_id = None
+            if self.stop.is_set(): return
+
+
+def start_server(db, port, threads, poll_retry):
+    env = dict(os.environ, DB_PATH=db, WEB_BIND=f'127.0.0.1:{port}', WEB_THREADS=str(threads), HASH_WORKERS='0',
+               EVENTS_HEARTBEAT='1', EVENTS_POLL_RETRY=str(poll_retry))
+    proc = subprocess.Popen(['gunicorn', '-c', 'gunicorn.conf.py'], cwd=root, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/readyz', timeout=1)
+            return proc
+        except Exception:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError('server did not become ready')
+
+
+def pct(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p / 100))] * 1000 if xs else 0
+
+
+def probe(base, n):
+    # /healthz latencies in seconds, None for a timeout
+    res = []
+    for _ in range(n):
+        t = time.perf_counter()
+        try:
+            urllib.request.urlopen(base + '/healthz', timeout=5).read()
+            res.append(time.perf_counter() - t)
+        except OSError:
+            res.append(None)
+    return res
+
+
+def main():
+    p = argparse.ArgumentParser(description='SSE clients against the gunicorn configuration')
+    p.add_argument('--cooks', type=int, default=50)
+    p.add_argument('--admins', type=int, default=10)
+    p.add_argument('--students', type=int, default=100)
+    p.add_argument('--orders', type=int, default=200)
+    p.add_argument('--requests', type=int, default=20)
+    p.add_argument('--threads', type=int, default=32, help='WEB_THREADS for gunicorn')
+    p.add_argument('--poll-retry', type=int, default=1000, help='EVENTS_POLL_RETRY in ms')
+    p.add_argument('--port', type=int, default=5098)
+    args = p.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    db = os.path.join(tmp, 'sse.db')
+    proc, stop = None, threading.Event()
+    try:
+        init_db.create_tables(db)
+        init_db.seed_data(db)
+        init_db.seed_load(4, 40, 2, db_path=db)
+        conn = sqlite3.connect(db)
+        conn.execute('UPDATE dishes SET current_stock = 1000000')
+        conn.commit()
+        menu_ids = [r[0] for r in conn.execute('SELECT id FROM menu WHERE id NOT IN (SELECT menu_id FROM orders) ORDER BY id')]
+        # seed_load's students; the seeded 'Student' runs out of money
+        student_names = [r[0] for r in conn.execute("SELECT username FROM users WHERE username GLOB 'student[0-9]*' ORDER BY id")]
+        conn.close()
+        proc = start_server(db, args.port, args.threads, args.poll_retry)
+        base = f'http://127.0.0.1:{args.port}'
+
+        # one login per user; the clients of a role share its cookie jar
+        cook, admin = Session(base, 'Cook'), Session(base, 'Admin')
+        students = [Session(base, name) for name in student_names]
+        pairs = [(s, m) for m in menu_ids for s in students][:args.orders]
+        if len(pairs) < args.orders: raise SystemExit(f'only {len(pairs)} distinct orders available')
+        ready = threading.Semaphore(0)
+        subs = ([Subscriber(cook, 'cook', ready, stop) for _ in range(args.cooks)] +
+                [Subscriber(admin, 'admin', ready, stop) for _ in range(args.admins)] +
+                [Subscriber(students[i % len(students)], 'student', ready, stop) for i in range(args.students)])
+        start = time.perf_counter()
+        for s in subs: s.start()
+        for _ in subs: ready.acquire()
+        print(f'{len(subs)} clients connected in {time.perf_counter() - start:.2f}s '
+              f'({sum(not s.polling for s in subs)} streaming, {sum(s.polling for s in subs)} polling), gunicorn threads {args.threads}')
+        health = probe(base, 20)
+
+        sent, statuses = [], {}
+        start = time.perf_counter()
+        for student, menu_id in pairs:
+            sent.append(time.perf_counter())
+            status = student.post('/api/orders', {'menu_id': menu_id})
+            statuses[status] = statuses.get(status, 0) + 1
+        for i in range(args.requests):
+            status = cook.post('/api/purchase_requests', {'ingredient_id': 1, 'quantity': 1})
+            statuses[status] = statuses.get(status, 0) + 1
+        wall = time.perf_counter() - start
+        expected = {'cook': {'order': args.orders}, 'admin': {'pending': args.requests}, 'student': {}}
+        deadline = time.monotonic() + 10 + 2 * args.poll_retry / 1000
+        while time.monotonic() < deadline and any(len(s.events) < sum(expected[s.role].values()) for s in subs):
+            time.sleep(0.05)
+    finally:
+        stop.set()
+        if proc:
+            proc.terminate()
+            proc.wait()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    ok = [h for h in health if h is not None]
+    print(f'/healthz with all clients connected: {len(ok)}/{len(health)} answered, p95 {pct(ok, 95):.1f} ms')
+    print(f'{args.orders} orders + {args.requests} purchase requests in {wall:.2f}s, responses: '
+          + ', '.join(f'{s}: {n}' for s, n in sorted(statuses.items())))
+    failed, latencies = [], {False: [], True: []}
+    for role in ('cook', 'admin', 'student'):
+        group = [s for s in subs if s.role == role]
+        for s in group:
+            got = {}
+            for name, _, _ in s.events: got[name] = got.get(name, 0) + 1
+            if got != expected[role]: failed.append(f'{role} client got {got}, expected {expected[role]}')
+            if role == 'cook':
+                orders = [t for name, _, t in s.events if name == 'order']
+                latencies[s.polling] += [t - sent[k] for k, t in enumerate(orders) if k < len(sent)]
+        counts = [len(s.events) for s in group]
+        print(f'{role:8} {len(group):5} clients, events received min {min(counts, default=0)} max {max(counts, default=0)}')
+    for polling, xs in latencies.items():
+        if xs: print(f"order -> cook ({'polling' if polling else 'streaming'}): p50 {pct(xs, 50):.1f} ms, "
+                     f'p95 {pct(xs, 95):.1f} ms, max {max(xs) * 1000:.1f} ms')
+    if len(ok) < len(health) or pct(ok, 95) > 1000: failed.append('/healthz is slow while clients are connected')
+    for msg in sorted(set(failed)): print('FAIL', msg)
+    if failed or set(statuses) != {200}: sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,372 @@
 import sqlite3
 import os
+import re
+import sys
 import json
+import random
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_NAME = 'school_canteen.db'
-DB_PATH = os.path.join(BASE_DIR, DB_NAME)
+DB_PATH = os.environ.get('DB_PATH', os.path.join(BASE_DIR, DB_NAME))
+# One database per school: <TENANTS_DIR>/<name>.db
+TENANTS_DIR = os.environ.get('TENANTS_DIR', os.path.join(BASE_DIR, 'tenants'))
+TENANT_RE = re.compile(r'[a-z0-9][a-z0-9-]{0,31}')
 
+# Rows moved to the archive database by archive(): table -> (day expression, archived columns)
+ARCHIVED_TABLES = {
+    'orders': ('order_day', 'id, user_id, menu_id, order_date, paid, collected, order_day'),
+    'payments': ('payment_day', 'id, user_id, amount, payment_date, type, order_id, status, payment_day'),
+    'reviews': ('substr(created_at, 1, 10)', 'id, user_id, dish_id, rating, comment, created_at'),
+}
+ARCHIVE_INDEXES = [
+    'CREATE UNIQUE INDEX IF NOT EXISTS archive.idx_orders_id ON orders(id)',
+    'CREATE INDEX IF NOT EXISTS archive.idx_orders_user ON orders(user_id, order_date)',
+    'CREATE INDEX IF NOT EXISTS archive.idx_orders_day ON orders(order_day)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS archive.idx_payments_id ON payments(id)',
+    'CREATE INDEX IF NOT EXISTS archive.idx_payments_user ON payments(user_id)',
+    'CREATE INDEX IF NOT EXISTS archive.idx_payments_day ON payments(payment_day)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS archive.idx_reviews_id ON reviews(id)',
+]
 
-def create_tables():
-    conn = sqlite3.connect(DB_PATH)
+REBUILD_STATS = [
+    'DELETE FROM daily_stats',
+    '''INSERT INTO daily_stats (day, meal_type, dish_id, orders, sold, issued, revenue)
+       SELECT o.order_day, m.meal_type, m.dish_id, COUNT(*), SUM(o.paid), SUM(o.collected), COALESCE(SUM(p.amount), 0)
+       FROM orders o JOIN menu m ON o.menu_id=m.id LEFT JOIN payments p ON p.order_id=o.id AND p.status='completed'
+       GROUP BY o.order_day, m.meal_type, m.dish_id''',
+    'DELETE FROM daily_payments',
+    '''INSERT INTO daily_payments (day, revenue, transactions)
+       SELECT payment_day, SUM(amount), COUNT(*) FROM payments WHERE status='completed' GROUP BY payment_day''',
+    "INSERT OR REPLACE INTO stats_totals (name, value) SELECT 'issued', COUNT(*) FROM orders WHERE collected=1",
+]
+
+REBUILD_COUNTERS = [
+    'UPDATE users SET orders_count=(SELECT COUNT(*) FROM orders WHERE orders.user_id=users.id)',
+]
+
+# Folds journal entries appended since the last run into users.balance_cents / ledger_seq (and the legacy
+# users.balance), then moves the watermark. Run inside one write transaction.
+MATERIALIZE_LEDGER = [
+    '''UPDATE users SET balance_cents = balance_cents + d.delta, balance = (balance_cents + d.delta) / 100.0, ledger_seq = d.seq
+       FROM (SELECT l.user_id, SUM(l.amount_cents) AS delta, MAX(l.seq) AS seq FROM ledger l JOIN users u ON u.id = l.user_id
+             WHERE l.id > COALESCE((SELECT value FROM stats_totals WHERE name = 'ledger_materialized'), 0) AND l.seq > u.ledger_seq
+             GROUP BY l.user_id) d
+       WHERE users.id = d.user_id''',
+    "INSERT OR REPLACE INTO stats_totals (name, value) SELECT 'ledger_materialized', COALESCE(MAX(id), 0) FROM ledger",
+]
+
+# Balances written straight into users.balance (seed data, pre-ledger databases) become an 'opening' entry.
+OPEN_LEDGER = [
+    '''INSERT INTO ledger (user_id, seq, amount_cents, kind)
+       SELECT id, 1, CAST(ROUND(balance * 100) AS INTEGER), 'opening' FROM users
+       WHERE ledger_seq = 0 AND CAST(ROUND(balance * 100) AS INTEGER) != 0 AND NOT EXISTS (SELECT 1 FROM ledger l WHERE l.user_id = users.id)''',
+] + MATERIALIZE_LEDGER
+
+# Review totals per dish; add_review() in Backend/app.py keeps them current.
+REBUILD_RATINGS = [
+    'DELETE FROM dish_ratings',
+    'INSERT INTO dish_ratings (dish_id, reviews, rating_sum) SELECT dish_id, COUNT(*), SUM(rating) FROM reviews GROUP BY dish_id',
+]
+
+# Orders per dish today / over 7 / over 30 days, ranked per window. A rollup of at most 30 days of daily_stats,
+# rewritten by the app every POPULARITY_REFRESH seconds rather than on each order.
+REFRESH_POPULARITY = [
+    'DELETE FROM dish_popularity',
+    '''INSERT INTO dish_popularity (period, dish_id, orders, rank)
+       WITH w(period, days) AS (VALUES ('today', 1), ('7d', 7), ('30d', 30))
+       SELECT period, dish_id, orders, RANK() OVER (PARTITION BY period ORDER BY orders DESC)
+       FROM (SELECT w.period, s.dish_id, SUM(s.orders) AS orders
+             FROM daily_stats s JOIN w ON s.day > date('now', 'localtime', -w.days || ' days')
+             WHERE s.day > date('now', 'localtime', '-30 days') AND s.day <= date('now', 'localtime')
+             GROUP BY w.period, s.dish_id)''',
+    "INSERT OR REPLACE INTO stats_totals (name, value) VALUES ('popularity_refreshed', CAST(strftime('%s', 'now') AS INTEGER))",
+]
+
+# balance = materialized part + journal entries appended since (an index range on ledger(user_id, seq))
+BALANCE_SQL = 'u.balance_cents + COALESCE((SELECT SUM(amount_cents) FROM ledger WHERE user_id = u.id AND seq > u.ledger_seq), 0)'
+
+# The hot queries of Backend/app.py; tests/test_query_plans.py checks their plans. {orders} and {payments} are the
+# table or, with ?archive=1, the live+archive union from history(); {cond} is an extra keyset condition.
+LOGIN_USER = 'SELECT * FROM users WHERE email=? OR username=?'
+MENU_FOR_DAY = ('SELECT m.id, m.meal_type, m.dish_id, d.name as dish_name, d.calories, d.price, d.current_stock '
+                'FROM menu m JOIN dishes d ON m.dish_id=d.id WHERE m.date=?')
+ORDERS_BY_USER = ('SELECT o.id, o.order_date as date, d.name as dish_name, d.price, o.paid, o.collected, d.id as dish_id '
+                  'FROM {orders} o JOIN menu m ON o.menu_id=m.id JOIN dishes d ON m.dish_id=d.id '
+                  'WHERE o.user_id=?{cond} ORDER BY o.order_date DESC, o.id DESC LIMIT ?')
+PENDING_REQUESTS = "SELECT COUNT(*) as c FROM purchase_requests WHERE status='pending'"
+DISHES_RESERVED = ("SELECT d.*, COALESCE(r.c, 0) as reserved FROM dishes d LEFT JOIN (SELECT m.dish_id, COUNT(o.id) as c "
+                   "FROM orders o JOIN menu m ON o.menu_id=m.id WHERE o.collected=0 AND o.order_day=date('now','localtime') "
+                   "GROUP BY m.dish_id) r ON r.dish_id=d.id")
+ORDERS_TO_COLLECT = ("SELECT o.id, d.name as dish_name, d.calories, m.meal_type FROM orders o JOIN menu m ON o.menu_id=m.id "
+                     "JOIN dishes d ON m.dish_id=d.id WHERE o.user_id=? AND o.collected=0 AND o.order_day=date('now','localtime')")
+STATS_TODAY_BY_MEAL = ("SELECT meal_type, SUM(issued) as issued, SUM(sold) as sold FROM daily_stats "
+                       "WHERE day=date('now','localtime') GROUP BY meal_type")
+STATS_TODAY_BY_DISH = ("SELECT d.name, SUM(s.orders) as count FROM daily_stats s JOIN dishes d ON s.dish_id=d.id "
+                       "WHERE s.day=date('now','localtime') GROUP BY d.name HAVING count > 0 ORDER BY count DESC")
+STATS_TODAY_ORDERS = "SELECT COALESCE(SUM(orders), 0) as c FROM daily_stats WHERE day=date('now','localtime')"
+STATS_TODAY_REVENUE = "SELECT revenue as s FROM daily_payments WHERE day=date('now','localtime')"
+STATS_REVENUE_WEEK = 'SELECT day as date, revenue, transactions FROM daily_payments ORDER BY day DESC LIMIT 7'
+# Exports read keyset-paginated chunks between the bounds returned by the *_SPAN query (a range on the day index),
+# so a narrow date range never walks the whole table: the statement ends with "id > ? AND id <= ? ORDER BY id LIMIT ?".
+EXPORT_PAYMENTS_SPAN = 'SELECT MIN(id), MAX(id) FROM {payments} WHERE payment_day BETWEEN ? AND ?'
+EXPORT_PAYMENTS = ('SELECT p.id, p.payment_date, p.user_id, u.username, p.type, p.amount, p.order_id, p.status '
+                   'FROM {payments} p LEFT JOIN users u ON p.user_id=u.id '
+                   'WHERE p.payment_day BETWEEN ? AND ? AND p.id > ? AND p.id <= ? ORDER BY p.id LIMIT ?')
+EXPORT_ORDERS_SPAN = 'SELECT MIN(id), MAX(id) FROM {orders} WHERE order_day BETWEEN ? AND ?'
+EXPORT_ORDERS = ('SELECT o.id, o.order_date, o.user_id, u.username, m.date as menu_date, m.meal_type, d.name as dish_name, '
+                 'd.price, o.paid, o.collected FROM {orders} o JOIN menu m ON o.menu_id=m.id JOIN dishes d ON m.dish_id=d.id '
+                 'LEFT JOIN users u ON o.user_id=u.id WHERE o.order_day BETWEEN ? AND ? AND o.id > ? AND o.id <= ? '
+                 'ORDER BY o.id LIMIT ?')
+EXPORT_USER_TOTALS = ('SELECT u.id, u.username, u.email, u.role, (' + BALANCE_SQL + ') / 100.0 AS balance, '
+                      '(SELECT COUNT(*) FROM {orders} o WHERE o.user_id=u.id AND o.order_day BETWEEN ?1 AND ?2) as orders, '
+                      "(SELECT COALESCE(SUM(p.amount), 0) FROM {payments} p WHERE p.user_id=u.id AND p.status='completed' "
+                      'AND p.payment_day BETWEEN ?1 AND ?2) as paid_total FROM users u WHERE u.id > ?3 AND u.id <= ?4 '
+                      'ORDER BY u.id LIMIT ?5')
+
+# Each entry upgrades the schema by one version (stored in PRAGMA user_version). Append only, never edit.
+MIGRATIONS = [
+    [
+        "ALTER TABLE orders ADD COLUMN order_day DATE GENERATED ALWAYS AS (substr(order_date, 1, 10)) VIRTUAL",
+        "ALTER TABLE payments ADD COLUMN payment_day DATE GENERATED ALWAYS AS (substr(payment_date, 1, 10)) VIRTUAL",
+        'CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)',
+        'CREATE INDEX IF NOT EXISTS idx_orders_user ON orders(user_id, order_date)',
+        'CREATE INDEX IF NOT EXISTS idx_orders_menu ON orders(menu_id)',
+        'CREATE INDEX IF NOT EXISTS idx_orders_day ON orders(order_day, collected)',
+        'CREATE INDEX IF NOT EXISTS idx_menu_date ON menu(date, meal_type)',
+        'CREATE INDEX IF NOT EXISTS idx_menu_dish ON menu(dish_id, date)',
+        'CREATE INDEX IF NOT EXISTS idx_payments_status_day ON payments(status, payment_day)',
+        'CREATE INDEX IF NOT EXISTS idx_payments_user ON payments(user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_purchase_requests_status ON purchase_requests(status, request_date)',
+        'CREATE INDEX IF NOT EXISTS idx_purchase_requests_requester ON purchase_requests(requested_by, approved_date)',
+    ],
+    [
+        # a student orders a menu item at most once. Older code inserted a second order when a pre-ordered meal
+        # was issued, so duplicates are merged into the oldest row: its paid/collected flags become the MAX of the
+        # group, payments are repointed to it, and the extra rows are kept in orders_merged for the history.
+        'CREATE TABLE IF NOT EXISTS orders_merged (id INTEGER PRIMARY KEY, merged_into INTEGER NOT NULL, user_id INTEGER NOT NULL, menu_id INTEGER NOT NULL, order_date DATETIME, paid BOOLEAN, collected BOOLEAN)',
+        '''INSERT INTO orders_merged (id, merged_into, user_id, menu_id, order_date, paid, collected)
+           SELECT o.id, k.keep, o.user_id, o.menu_id, o.order_date, o.paid, o.collected
+           FROM orders o JOIN (SELECT user_id, menu_id, MIN(id) AS keep FROM orders GROUP BY user_id, menu_id HAVING COUNT(*) > 1) k
+             ON k.user_id = o.user_id AND k.menu_id = o.menu_id WHERE o.id != k.keep''',
+        '''UPDATE orders SET paid = d.paid, collected = d.collected
+           FROM (SELECT merged_into, MAX(paid) AS paid, MAX(collected) AS collected FROM
+                 (SELECT merged_into, paid, collected FROM orders_merged UNION ALL
+                  SELECT id, paid, collected FROM orders WHERE id IN (SELECT merged_into FROM orders_merged))
+                 GROUP BY merged_into) d
+           WHERE orders.id = d.merged_into''',
+        'UPDATE payments SET order_id = (SELECT merged_into FROM orders_merged WHERE id = payments.order_id) WHERE order_id IN (SELECT id FROM orders_merged)',
+        'DELETE FROM orders WHERE id IN (SELECT id FROM orders_merged)',
+        'CREATE UNIQUE INDEX IF NOT EXISTS idx_orders_user_menu ON orders(user_id, menu_id)',
+    ],
+    [
+        # rollups kept up to date by the write paths in Backend/app.py; rebuild_stats() recomputes them from scratch
+        'CREATE TABLE daily_stats (day DATE NOT NULL, meal_type TEXT NOT NULL, dish_id INTEGER NOT NULL, orders INTEGER DEFAULT 0, sold INTEGER DEFAULT 0, issued INTEGER DEFAULT 0, revenue DECIMAL(10, 2) DEFAULT 0, PRIMARY KEY (day, meal_type, dish_id))',
+        'CREATE TABLE daily_payments (day DATE PRIMARY KEY, revenue DECIMAL(10, 2) DEFAULT 0, transactions INTEGER DEFAULT 0)',
+        'CREATE TABLE stats_totals (name TEXT PRIMARY KEY, value INTEGER DEFAULT 0)',
+    ] + REBUILD_STATS,
+    [
+        'ALTER TABLE users ADD COLUMN orders_count INTEGER DEFAULT 0',
+        'CREATE INDEX IF NOT EXISTS idx_purchase_requests_date ON purchase_requests(request_date)',
+    ] + REBUILD_COUNTERS,
+    [
+        # student lookup at the serving line is case-insensitive on username and email
+        'CREATE INDEX IF NOT EXISTS idx_users_username_nocase ON users(username COLLATE NOCASE)',
+        'CREATE INDEX IF NOT EXISTS idx_users_email_nocase ON users(email COLLATE NOCASE)',
+    ],
+    [
+        # append-only money journal in integer cents; seq numbers each user's entries 1, 2, 3, ...
+        'CREATE TABLE ledger (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, seq INTEGER NOT NULL, amount_cents INTEGER NOT NULL, kind TEXT NOT NULL, payment_id INTEGER, created_at DATETIME DEFAULT CURRENT_TIMESTAMP, UNIQUE (user_id, seq))',
+        'ALTER TABLE users ADD COLUMN balance_cents INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE users ADD COLUMN ledger_seq INTEGER NOT NULL DEFAULT 0',
+    ] + OPEN_LEDGER,
+    [
+        # dish rating totals and the cached popularity rankings served by /api/dishes and /api/menu/today
+        'CREATE TABLE dish_ratings (dish_id INTEGER PRIMARY KEY, reviews INTEGER NOT NULL DEFAULT 0, rating_sum INTEGER NOT NULL DEFAULT 0)',
+        'CREATE TABLE dish_popularity (period TEXT NOT NULL, dish_id INTEGER NOT NULL, orders INTEGER NOT NULL, rank INTEGER NOT NULL, PRIMARY KEY (period, dish_id))',
+    ] + REBUILD_RATINGS + REFRESH_POPULARITY,
+    [
+        # menu.max_portions used to default to 100 without being enforced; those implicit caps become "no limit".
+        # Existing databases keep the column default, so the app always writes max_portions explicitly
+        'UPDATE menu SET max_portions = NULL WHERE max_portions = 100',
+    ],
+    [
+        # payments export by date: idx_payments_status_day only helps when the status is fixed
+        'CREATE INDEX IF NOT EXISTS idx_payments_day ON payments(payment_day)',
+    ],
+]
+
+
+def migrate(db_path=None):
+    # the version is read again under the write lock before each step, so concurrent callers (workers, a school
+    # opened by two requests at once) apply every migration exactly once
+    conn = sqlite3.connect(db_path or DB_PATH, isolation_level=None, timeout=30)
+    try:
+        while conn.execute('PRAGMA user_version').fetchone()[0] < len(MIGRATIONS):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                version = conn.execute('PRAGMA user_version').fetchone()[0]
+                if version < len(MIGRATIONS):
+                    for sql in MIGRATIONS[version]: conn.execute(sql)
+                    conn.execute(f'PRAGMA user_version={version + 1}')
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+    finally:
+        conn.close()
+    return len(MIGRATIONS)
+
+
+def archive_path(db_path=None):
+    # ARCHIVE_DB_PATH only overrides the archive of the main database, never a tenant's
+    override = os.environ.get('ARCHIVE_DB_PATH') if (db_path or DB_PATH) == DB_PATH else None
+    return override or os.path.splitext(db_path or DB_PATH)[0] + '_archive.db'
+
+
+def tenant_path(name, tenants_dir=None):
+    return os.path.join(tenants_dir or TENANTS_DIR, f'{name}.db')
+
+
+def tenant_names(tenants_dir=None):
+    folder = tenants_dir or TENANTS_DIR
+    if not os.path.isdir(folder): return []
+    names = (f[:-3] for f in os.listdir(folder) if f.endswith('.db') and not f.endswith('_archive.db'))
+    return sorted(n for n in names if TENANT_RE.fullmatch(n))
+
+
+def create_tenants(names, tenants_dir=None):
+    # schema and starter data for new schools; an existing database is never recreated
+    os.makedirs(tenants_dir or TENANTS_DIR, exist_ok=True)
+    created = []
+    for name in names:
+        if not TENANT_RE.fullmatch(name): raise ValueError(f'bad tenant name: {name}')
+        path = tenant_path(name, tenants_dir)
+        if os.path.exists(path): continue
+        create_tables(path)
+        seed_data(path)
+        migrate(path)
+        created.append(name)
+    return created
+
+
+def migrate_tenants(tenants_dir=None, workers=8):
+    # every school has its own file and write lock, so migrations run side by side
+    names = tenant_names(tenants_dir)
+    with ThreadPoolExecutor(workers) as pool:
+        versions = pool.map(lambda n: migrate(tenant_path(n, tenants_dir)), names)
+    return dict(zip(names, versions))
+
+
+def shadow_with_archive(conn, db_path=None):
+    # TEMP views named like the live tables shadow them on this connection, so rollups rebuilt through it
+    # still count archived history
+    path = archive_path(db_path)
+    if not os.path.exists(path): return
+    conn.execute('ATTACH DATABASE ? AS archive', (path,))
+    for table, (_, cols) in ARCHIVED_TABLES.items():
+        conn.execute(f'CREATE TEMP VIEW {table} AS SELECT {cols} FROM main.{table} UNION ALL SELECT {cols} FROM archive.{table}')
+
+
+def rebuild_stats(db_path=None):
+    conn = sqlite3.connect(db_path or DB_PATH)
+    shadow_with_archive(conn, db_path)
+    with conn:
+        for sql in REBUILD_STATS + REBUILD_COUNTERS + REBUILD_RATINGS + REFRESH_POPULARITY: conn.execute(sql)
+    conn.close()
+
+
+def reconcile(db_path=None):
+    # one merge pass over users and the journal, both read in (user_id, seq) order straight off their indexes
+    conn = sqlite3.connect(db_path or DB_PATH)
+    entries = conn.execute('SELECT user_id, seq, amount_cents FROM ledger ORDER BY user_id, seq')
+    problems, pending = [], next(entries, None)
+    for uid, balance_cents, ledger_seq in conn.execute('SELECT id, balance_cents, ledger_seq FROM users ORDER BY id'):
+        while pending and pending[0] < uid:
+            problems.append(f'ledger entries for missing user {pending[0]}')
+            skip = pending[0]
+            while pending and pending[0] == skip: pending = next(entries, None)
+        total = seq = 0
+        while pending and pending[0] == uid:
+            if pending[1] != seq + 1: problems.append(f'user {uid}: seq jumps from {seq} to {pending[1]}')
+            seq = pending[1]
+            if seq <= ledger_seq: total += pending[2]
+            pending = next(entries, None)
+        if ledger_seq > seq: problems.append(f'user {uid}: materialized up to seq {ledger_seq}, journal ends at {seq}')
+        if total != balance_cents: problems.append(f'user {uid}: balance_cents {balance_cents} != journal {total}')
+    while pending:
+        problems.append(f'ledger entries for missing user {pending[0]}')
+        skip = pending[0]
+        while pending and pending[0] == skip: pending = next(entries, None)
+    conn.close()
+    return problems
+
+
+def default_cutoff():
+    # start of the current half of the school year: 1 September or 1 January
+    today = datetime.now().date()
+    return today.replace(month=9 if today.month >= 9 else 1, day=1).isoformat()
+
+
+def archive(cutoff=None, db_path=None, batch=5000):
+    # Moves orders, payments and reviews dated before `cutoff` into the archive database in batches of
+    # `batch` rows, one short write transaction each, so the app keeps serving meanwhile. The rollups keep
+    # their totals. Rows are copied with INSERT OR IGNORE before being deleted: a crash between the two files
+    # leaves duplicates that the next run cleans up, never losses.
+    cutoff = cutoff or default_cutoff()
+    conn = sqlite3.connect(db_path or DB_PATH, isolation_level=None, timeout=30)
+    conn.execute('ATTACH DATABASE ? AS archive', (archive_path(db_path),))
+    for table, (_, cols) in ARCHIVED_TABLES.items():
+        conn.execute(f'CREATE TABLE IF NOT EXISTS archive.{table} AS SELECT {cols} FROM main.{table} WHERE 0')
+    for sql in ARCHIVE_INDEXES: conn.execute(sql)
+    moved = {}
+    for table, (day, cols) in ARCHIVED_TABLES.items():
+        moved[table] = 0
+        while True:
+            conn.execute('BEGIN IMMEDIATE')
+            last = conn.execute(f'SELECT MAX(id) FROM (SELECT id FROM main.{table} WHERE {day} < ? ORDER BY id LIMIT ?)',
+                                (cutoff, batch)).fetchone()[0]
+            if last is None:
+                conn.execute('COMMIT')
+                break
+            conn.execute(f'INSERT OR IGNORE INTO archive.{table} ({cols}) SELECT {cols} FROM main.{table} WHERE id <= ? AND {day} < ?',
+                         (last, cutoff))
+            moved[table] += conn.execute(f'DELETE FROM main.{table} WHERE id <= ? AND {day} < ?', (last, cutoff)).rowcount
+            conn.execute('COMMIT')
+            # returns the freed pages to the OS once enable_incremental_vacuum() has run; a no-op before that
+            conn.execute('PRAGMA main.incremental_vacuum')
+    conn.close()
+    return moved
+
+
+def incremental_vacuum_enabled(db_path=None):
+    conn = sqlite3.connect(db_path or DB_PATH)
+    mode = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+    conn.close()
+    return mode == 2
+
+
+def enable_incremental_vacuum(db_path=None):
+    # A one-off conversion to auto_vacuum=INCREMENTAL. It takes a full VACUUM, which rewrites the whole file and
+    # holds the write lock until done (and needs as much free disk again), so run it in a maintenance window,
+    # never next to the running app. Afterwards archive() hands freed pages back to the OS after every batch.
+    if incremental_vacuum_enabled(db_path): return False
+    conn = sqlite3.connect(db_path or DB_PATH, isolation_level=None, timeout=30)
+    conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    conn.execute('VACUUM')
+    conn.close()
+    return True
+
+
+def create_tables(db_path=None):
+    conn = sqlite3.connect(db_path or DB_PATH)
     cursor = conn.cursor()
 
     tables = ['users', 'dishes', 'ingredients', 'dish_ingredients', 'menu',
-              'orders', 'payments', 'allergens', 'reviews', 'purchase_requests']
+              'orders', 'payments', 'allergens', 'reviews', 'purchase_requests',
+              'daily_stats', 'daily_payments', 'stats_totals', 'ledger', 'dish_ratings', 'dish_popularity', 'orders_merged']
     for table in tables:
         cursor.execute(f'DROP TABLE IF EXISTS {table}')
 
@@ -29,7 +381,7 @@ def create_tables():
     cursor.execute(
         'CREATE TABLE dish_ingredients (dish_id INTEGER NOT NULL, ingredient_id INTEGER NOT NULL, quantity REAL NOT NULL, PRIMARY KEY (dish_id, ingredient_id), FOREIGN KEY (dish_id) REFERENCES dishes(id) ON DELETE CASCADE, FOREIGN KEY (ingredient_id) REFERENCES ingredients(id) ON DELETE CASCADE)')
     cursor.execute(
-        'CREATE TABLE menu (id INTEGER PRIMARY KEY AUTOINCREMENT, date DATE NOT NULL, meal_type TEXT NOT NULL, dish_id INTEGER NOT NULL, max_portions INTEGER DEFAULT 100, FOREIGN KEY (dish_id) REFERENCES dishes(id) ON DELETE CASCADE)')
+        'CREATE TABLE menu (id INTEGER PRIMARY KEY AUTOINCREMENT, date DATE NOT NULL, meal_type TEXT NOT NULL, dish_id INTEGER NOT NULL, max_portions INTEGER, FOREIGN KEY (dish_id) REFERENCES dishes(id) ON DELETE CASCADE)')
     cursor.execute(
         'CREATE TABLE orders (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, menu_id INTEGER NOT NULL, order_date DATETIME DEFAULT CURRENT_TIMESTAMP, paid BOOLEAN DEFAULT 0, collected BOOLEAN DEFAULT 0, FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE, FOREIGN KEY (menu_id) REFERENCES menu(id) ON DELETE CASCADE)')
     cursor.execute(
@@ -40,13 +392,15 @@ def create_tables():
         'CREATE TABLE reviews (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, dish_id INTEGER NOT NULL, rating INTEGER NOT NULL, comment TEXT, created_at DATETIME DEFAULT CURRENT_TIMESTAMP)')
     cursor.execute(
         'CREATE TABLE purchase_requests (id INTEGER PRIMARY KEY AUTOINCREMENT, ingredient_id INTEGER NOT NULL, quantity REAL NOT NULL, requested_by INTEGER NOT NULL, request_date DATETIME DEFAULT CURRENT_TIMESTAMP, status TEXT DEFAULT "pending", approved_by INTEGER NULL, approved_date DATETIME NULL, notes TEXT)')
+    cursor.execute('PRAGMA user_version=0')
 
     conn.commit()
     conn.close()
+    migrate(db_path)
 
 
-def seed_data():
-    conn = sqlite3.connect(DB_PATH)
+def seed_data(db_path=None):
+    conn = sqlite3.connect(db_path or DB_PATH)
     cursor = conn.cursor()
     pw = generate_password_hash('1234')
     today = datetime.now().date()
@@ -81,10 +435,91 @@ def seed_data():
     menu = [(today.isoformat(), 'breakfast', dish_map['Омлет']), (today.isoformat(), 'lunch', dish_map['Борщ'])]
     cursor.executemany('INSERT INTO menu (date, meal_type, dish_id) VALUES (?, ?, ?)', menu)
 
+    for sql in OPEN_LEDGER: cursor.execute(sql)
+    conn.commit()
+    conn.close()
+
+
+def seed_load(students=500, dishes=40, weeks=4, seed=42, db_path=None):
+    # synthetic school for benchmarks: extra students and dishes, a menu for every school day
+    # from `weeks` ago to a week ahead, and collected, paid orders for every past day
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(db_path or DB_PATH)
+    cursor = conn.cursor()
+    pw = generate_password_hash('1234')
+    today = datetime.now().date()
+
+    cursor.executemany(
+        "INSERT INTO users (username, email, password_hash, role, balance) VALUES (?, ?, ?, 'student', 100000)",
+        [(f'student{i}', f'student{i}@school.ru', pw) for i in range(students)])
+    student_ids = [r[0] for r in cursor.execute("SELECT id FROM users WHERE role='student'")]
+
+    cursor.executemany('INSERT INTO dishes (name, calories, current_stock, price) VALUES (?, ?, ?, ?)',
+                       [(f'Блюдо {i}', rnd.randint(150, 600), students * 10, rnd.choice([50, 70, 90, 120]))
+                        for i in range(dishes)])
+    dish_ids = [r[0] for r in cursor.execute('SELECT id FROM dishes')]
+    ing_ids = [r[0] for r in cursor.execute('SELECT id FROM ingredients')]
+    cursor.executemany('INSERT OR IGNORE INTO dish_ingredients (dish_id, ingredient_id, quantity) VALUES (?, ?, ?)',
+                       [(d, i, round(rnd.uniform(0.05, 0.3), 2)) for d in dish_ids
+                        for i in rnd.sample(ing_ids, min(len(ing_ids), rnd.randint(2, 4)))])
+
+    days = [today + timedelta(days=n) for n in range(-7 * weeks, 8) if (today + timedelta(days=n)).weekday() < 5]
+    for day in days:
+        cursor.executemany('INSERT INTO menu (date, meal_type, dish_id) VALUES (?, ?, ?)',
+                           [(day.isoformat(), 'breakfast', d) for d in rnd.sample(dish_ids, min(3, len(dish_ids)))] +
+                           [(day.isoformat(), 'lunch', d) for d in rnd.sample(dish_ids, min(4, len(dish_ids)))])
+
+    prices = dict(cursor.execute('SELECT id, price FROM dishes').fetchall())
+    for day in [d for d in days if d < today]:
+        menu = cursor.execute('SELECT id, dish_id FROM menu WHERE date=?', (day.isoformat(),)).fetchall()
+        orders = [(uid, mid, f'{day.isoformat()} {rnd.randint(7, 13):02d}:{rnd.randint(0, 59):02d}:00', prices[did])
+                  for uid in student_ids if rnd.random() < 0.6 for mid, did in [rnd.choice(menu)]]
+        cursor.executemany(
+            'INSERT OR IGNORE INTO orders (user_id, menu_id, order_date, paid, collected) VALUES (?, ?, ?, 0, 1)',
+            [o[:3] for o in orders])
+        cursor.execute(
+            "INSERT INTO payments (user_id, amount, payment_date, type, order_id, status) SELECT o.user_id, d.price, o.order_date, 'single', o.id, 'completed' FROM orders o JOIN menu m ON o.menu_id=m.id JOIN dishes d ON m.dish_id=d.id WHERE o.order_day=?",
+            (day.isoformat(),))
+
+    for sql in OPEN_LEDGER: cursor.execute(sql)
     conn.commit()
     conn.close()
+    rebuild_stats(db_path)
 
 
 if __name__ == '__main__':
-    create_tables()
-    seed_data()
+    if 'migrate' in sys.argv[1:]:
+        migrate()
+    elif 'rebuild-stats' in sys.argv[1:]:
+        migrate()
+        rebuild_stats()
+    elif 'reconcile' in sys.argv[1:]:
+        migrate()
+        problems = reconcile()
+        for line in problems: print(line)
+        print(f'{len(problems)} problem(s)')
+        sys.exit(1 if problems else 0)
+    elif 'archive' in sys.argv[1:]:
+        migrate()
+        cutoff = sys.argv[2] if len(sys.argv) > 2 else None
+        for table, n in archive(cutoff).items(): print(f'{table}: {n} archived')
+        if not incremental_vacuum_enabled():
+            print('freed pages stay in the file: run "init_db.py enable-incremental-vacuum" in a maintenance window')
+    elif 'enable-incremental-vacuum' in sys.argv[1:]:
+        print('converted' if enable_incremental_vacuum() else 'already incremental')
+    elif sys.argv[1:2] == ['tenants']:
+        # tenants create <name>... | tenants migrate | tenants list
+        cmd = sys.argv[2] if len(sys.argv) > 2 else 'list'
+        if cmd == 'create':
+            for name in create_tenants(sys.argv[3:]): print(f'{name}: created')
+        elif cmd == 'migrate':
+            for name, version in migrate_tenants().items(): print(f'{name}: schema {version}')
+        else:
+            for name in tenant_names(): print(name)
+    elif 'seed-load' in sys.argv[1:]:
+        create_tables()
+        seed_data()
+        seed_load(*[int(a) for a in sys.argv[2:5]])
+    else:
+        create_tables()
+        seed_data()
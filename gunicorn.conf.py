@@ -0,0 +1,33 @@
+import os
+import signal
+
+# Production entry point: gunicorn -c gunicorn.conf.py
+pythonpath = 'Backend'
+wsgi_app = 'app:create_app()'
+bind = os.environ.get('WEB_BIND', '0.0.0.0:5000')
+
+# SQLite has a single writer, so concurrency comes from threads, not processes.
+# The SSE event bus and the menu/principal caches live in the worker process:
+# with more than one worker, /api/events only sees events published by the same worker.
+workers = int(os.environ.get('WEB_WORKERS', 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 32))
+
+# migrations and static precompression run once in the master before forking
+preload_app = True
+timeout = 60
+graceful_timeout = int(os.environ.get('WEB_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+accesslog = '-'
+
+
+def post_worker_init(worker):
+    # let open SSE streams finish and /readyz report 503 as soon as shutdown starts
+    from app import shutting_down
+    handle_exit = worker.handle_exit
+
+    def on_exit(sig, frame):
+        shutting_down.set()
+        handle_exit(sig, frame)
+
+    signal.signal(signal.SIGTERM, on_exit)
@@ -0,0 +1,100 @@
+import os
+import sys
+import sqlite3
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'database'))
+import init_db
+
+# The hot queries of Backend/app.py (shared through init_db) must be index searches, not table scans
+
+
+@pytest.fixture(scope='module')
+def conn(tmp_path_factory):
+    db = str(tmp_path_factory.mktemp('plans') / 'plans.db')
+    init_db.create_tables(db)
+    init_db.seed_data(db)
+    conn = sqlite3.connect(db)
+    yield conn
+    conn.close()
+
+
+def plan(conn, sql, params=()):
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+
+def assert_searches(steps, table, index):
+    assert not [s for s in steps if s.startswith(f'SCAN {table}')], steps
+    assert [s for s in steps if s.startswith(f'SEARCH {table} ') and index in s], steps
+
+
+def test_schema_is_current(conn):
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == len(init_db.MIGRATIONS)
+
+
+def test_login_by_email_or_username(conn):
+    steps = plan(conn, init_db.LOGIN_USER, ('student1', 'student1'))
+    assert 'MULTI-INDEX OR' in steps
+    assert_searches(steps, 'users', '(email=?)')
+    assert_searches(steps, 'users', 'idx_users_username')
+
+
+def test_orders_by_user(conn):
+    steps = plan(conn, init_db.ORDERS_BY_USER.format(orders='orders', cond=''), (1, 50))
+    assert_searches(steps, 'o', 'idx_orders_user')
+    assert not [s for s in steps if 'TEMP B-TREE' in s], steps
+
+
+def test_menu_by_date(conn):
+    steps = plan(conn, init_db.MENU_FOR_DAY, ('2025-09-01',))
+    assert_searches(steps, 'm', 'idx_menu_date')
+
+
+def test_purchase_requests_by_status(conn):
+    steps = plan(conn, init_db.PENDING_REQUESTS)
+    assert_searches(steps, 'purchase_requests', 'idx_purchase_requests_status')
+
+
+def test_dishes_reserved_today(conn):
+    steps = plan(conn, init_db.DISHES_RESERVED)
+    assert_searches(steps, 'o', 'idx_orders_day (order_day=? AND collected=?)')
+
+
+def test_orders_to_collect(conn):
+    steps = plan(conn, init_db.ORDERS_TO_COLLECT, (1,))
+    assert_searches(steps, 'o', 'idx_orders_day (order_day=? AND collected=?)')
+
+
+@pytest.mark.parametrize('sql', [init_db.STATS_TODAY_BY_MEAL, init_db.STATS_TODAY_BY_DISH, init_db.STATS_TODAY_ORDERS])
+def test_stats_today(conn, sql):
+    steps = plan(conn, sql)
+    assert [s for s in steps if s.startswith('SEARCH') and '(day=?)' in s], steps
+    assert not [s for s in steps if s.startswith('SCAN')], steps
+
+
+def test_revenue_today(conn):
+    assert_searches(plan(conn, init_db.STATS_TODAY_REVENUE), 'daily_payments', '(day=?)')
+
+
+@pytest.mark.parametrize('span, index', [(init_db.EXPORT_ORDERS_SPAN.format(orders='orders'), 'idx_orders_day'),
+                                         (init_db.EXPORT_PAYMENTS_SPAN.format(payments='payments'), 'idx_payments_day')])
+def test_export_span_by_day(conn, span, index):
+    table = 'orders' if 'orders' in span else 'payments'
+    assert_searches(plan(conn, span, ('2025-09-01', '2025-09-30')), table, index)
+
+
+@pytest.mark.parametrize('sql, alias', [(init_db.EXPORT_ORDERS.format(orders='orders'), 'o'),
+                                        (init_db.EXPORT_PAYMENTS.format(payments='payments'), 'p')])
+def test_export_chunks_by_id(conn, sql, alias):
+    steps = plan(conn, sql, ('2025-09-01', '2025-09-30', 0, 100, 1000))
+    assert_searches(steps, alias, 'INTEGER PRIMARY KEY (rowid>? AND rowid<?)')
+    assert not [s for s in steps if 'TEMP B-TREE' in s], steps
+
+
+def test_export_user_totals(conn):
+    steps = plan(conn, init_db.EXPORT_USER_TOTALS.format(orders='orders', payments='payments'),
+                 ('2025-09-01', '2025-09-30', 0, 100, 1000))
+    assert_searches(steps, 'u', 'INTEGER PRIMARY KEY')
+    assert_searches(steps, 'o', '(user_id=?)')
+    assert_searches(steps, 'p', 'idx_payments_status_day (status=? AND payment_day>? AND payment_day<?)')